@@ -16,13 +16,100 @@
 #
 #############################################################################
 
+from functools import lru_cache
 import os
 import shutil
+import subprocess
 import grass.script as grass
+from grass.script.task import command_info
 import multiprocessing as mp
 import psutil
 
 
+def insert_rows(table, columns, rows, batch_size=500):
+    """Insert rows into a table with several INSERT statements, which are
+    passed to db.execute via stdin, as the SQL can exceed the maximum length
+    of a command line argument for many rows. Each statement contains at
+    most batch_size rows, so that it stays below the SQL length limit of
+    the database.
+    Args:
+        table (str): Name of the table
+        columns (list): Names of the columns to fill
+        rows (list): List of rows, each a list of the values as SQL strings
+        batch_size (int): Maximum number of rows per INSERT statement
+    """
+    if not rows:
+        return
+    insert_str = f"INSERT INTO {table} ( {', '.join(columns)} ) VALUES "
+    statements = []
+    for start in range(0, len(rows), batch_size):
+        values = ", ".join(
+            f"( {', '.join(row)} )" for row in rows[start : start + batch_size]
+        )
+        statements.append(f"{insert_str}{values};\n")
+    grass.write_command(
+        "db.execute", input="-", stdin="".join(statements), quiet=True
+    )
+
+
+def add_area_fd_columns(vector, area_col, fd_col, temp_table):
+    """Add the area in sqm and the fractal dimension of the areas of a vector
+    map to its attribute table. Both values are computed in parallel by
+    v.to.db without writing to the database, and the results are written
+    into a temporary table, which is then joined.
+    Args:
+        vector (str): Name of the vector map
+        area_col (str): Name of the new area column
+        fd_col (str): Name of the new fractal dimension column
+        temp_table (str): Name of the temporary table; has to be removed by
+                          the calling module
+    """
+    kwargs = {
+        "map": vector,
+        "units": "meters",
+        "separator": "pipe",
+        "flags": "p",
+        "quiet": True,
+    }
+    area_proc = grass.pipe_command("v.to.db", option="area", **kwargs)
+    fd_proc = grass.pipe_command("v.to.db", option="fd", **kwargs)
+    values = {}
+    for col, proc in ((area_col, area_proc), (fd_col, fd_proc)):
+        output = grass.decode(proc.communicate()[0])
+        if proc.returncode != 0:
+            grass.fatal(_(f"Computing <{col}> of <{vector}> failed"))
+        for line in output.splitlines():
+            cat, value = line.split("|")
+            # skip the header line
+            if not cat.isdigit():
+                continue
+            if value.lstrip("-") in ("nan", "inf"):
+                value = "NULL"
+            values.setdefault(cat, {})[col] = value
+
+    create_table_str = (
+        f"CREATE TABLE {temp_table} (cat integer,"
+        f" {area_col} double precision, {fd_col} double precision)"
+    )
+    grass.run_command("db.execute", sql=create_table_str)
+    insert_rows(
+        temp_table,
+        ["cat", area_col, fd_col],
+        [
+            [cat, val.get(area_col, "NULL"), val.get(fd_col, "NULL")]
+            for cat, val in values.items()
+        ],
+    )
+    grass.run_command(
+        "v.db.join",
+        map=vector,
+        column="cat",
+        other_table=temp_table,
+        other_column="cat",
+        quiet=True,
+    )
+
+
 def build_raster_vrt(raster_list, output_name):
     """Build raster VRT if the length of the raster list is greater 1 otherwise
     renaming of the raster
@@ -131,11 +218,9 @@ def create_grid(tile_size, grid_prefix, area):
         )
 
     # create list of tiles
-    tiles_num_list = list(
-        grass.parse_command(
-            "v.db.select", map=grid_name, columns="cat", flags="c", quiet=True
-        ).keys()
-    )
+    tiles_num_list = grass.read_command(
+        "v.db.select", map=grid_name, columns="cat", flags="c", quiet=True
+    ).splitlines()
 
     number_tiles = len(tiles_num_list)
     grass.message(_(f"Number of tiles is: {number_tiles}"))
@@ -152,8 +237,7 @@ def create_grid(tile_size, grid_prefix, area):
         tiles_list.append(tile_area)
 
     # cleanup
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
+    kwargs = {"flags": "f", "quiet": True, "stderr": subprocess.DEVNULL}
     for rmv in [grid, grid_name]:
         if grass.find_file(name=rmv, element="vector")["file"]:
             grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
@@ -169,27 +253,72 @@ def get_bins():
     return bins
 
 
+def get_ndsm_transform_expression(output, ndsm, p_low, med, p_high):
+    """Create the r.mapcalc expression for the square root transformation
+    of the nDSM around its median. The difference to the median is computed
+    once per cell by eval() and the scale factors of both branches are
+    precomputed, so that each cell only needs a multiplication and sqrt.
+    Args:
+        output (str): Name of the transformed output raster map
+        ndsm (str): Name of the nDSM raster map
+        p_low (float): Low percentile of the nDSM
+        med (float): Median of the nDSM
+        p_high (float): High percentile of the nDSM
+    Returns:
+        (str): The r.mapcalc expression
+    """
+    med = float(med)
+    range_high = float(p_high) - med
+    range_low = med - float(p_low)
+    # a division by a zero range results in NULL in r.mapcalc
+    trans_high = (
+        f"sqrt(ndsm_diff * {1.0 / range_high})" if range_high else "null()"
+    )
+    trans_low = (
+        f"-1.0 * sqrt(-ndsm_diff * {1.0 / range_low})"
+        if range_low
+        else "null()"
+    )
+    return (
+        f"{output} = eval(ndsm_diff = {ndsm} - {med}, "
+        f"float(if(ndsm_diff >= 0, {trans_high}, {trans_low})))"
+    )
+
+
+def get_nprocs_kwargs(module, nprocs):
+    """Get the nprocs parameter for a GRASS module if the installed GRASS GIS
+    version supports multithreading for this module
+    Args:
+        module (str): Name of the GRASS module
+        nprocs (int): Number of threads to use
+    Returns:
+        (dict): {"nprocs": nprocs} if supported, otherwise an empty dict
+    """
+    params = [param["name"] for param in command_info(module)["params"]]
+    if "nprocs" in params:
+        return {"nprocs": nprocs}
+    return {}
+
+
 def get_percentile(raster, percentiles):
     bins = get_bins()
-    perc_values_list = list(
-        (
-            grass.parse_command(
-                "r.quantile",
-                input=raster,
-                percentiles=percentiles,
-                bins=bins,
-                quiet=True,
-            )
-        ).keys()
-    )
+    perc_values_list = grass.read_command(
+        "r.quantile",
+        input=raster,
+        percentiles=percentiles,
+        bins=bins,
+        quiet=True,
+    ).splitlines()
     if isinstance(percentiles, list):
-        return [item.split(":")[2] for item in perc_values_list]
+        return [item.rsplit(":", 1)[1] for item in perc_values_list]
     else:
-        return float(perc_values_list[0].split(":")[2])
+        return float(perc_values_list[0].rsplit(":", 1)[1])
 
 
+@lru_cache(maxsize=4)
 def get_free_ram(unit, percent=100):
     """The function gives the amount of the percentages of the installed RAM.
+    The result is cached for the run of the calling module.
     Args:
         unit(string): 'GB' or 'MB'
         percent(int): number of percent which should be used of the free RAM
@@ -215,14 +344,37 @@ def get_free_ram(unit, percent=100):
         grass.fatal(_(f"Memory unit <{unit}> not supported"))
 
 
+def remove_temporary_maps(rm_rasters=(), rm_vectors=(), rm_groups=()):
+    """Remove temporary maps and groups of a (worker) module if they exist
+    Args:
+        rm_rasters (list of strings): Names of the raster maps to remove
+        rm_vectors (list of strings): Names of the vector maps to remove
+        rm_groups (list of strings): Names of the imagery groups to remove
+    """
+    kwargs = {"flags": "f", "quiet": True, "stderr": subprocess.DEVNULL}
+    # g.remove ignores not existing maps, so all maps of a type are removed
+    # at once without checking their existence first
+    for rm_type, rm_list in (
+        ("raster", rm_rasters),
+        ("vector", rm_vectors),
+        ("group", rm_groups),
+    ):
+        if rm_list:
+            grass.run_command(
+                "g.remove",
+                type=rm_type,
+                name=",".join(dict.fromkeys(rm_list)),
+                **kwargs,
+            )
+
+
 def reset_region(region):
     """Function to set the region to the given region
     Args:
         region (str): the name of the saved region which should be set and
                       deleted
     """
-    nulldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nulldev}
+    kwargs = {"flags": "f", "quiet": True, "stderr": subprocess.DEVNULL}
     if region:
         if grass.find_file(name=region, element="windows")["file"]:
             grass.run_command("g.region", region=region)
@@ -298,6 +450,10 @@ def switch_to_new_mapset(new_mapset):
 def test_memory(memory_string):
     # check memory
     memory = int(memory_string)
+    # small memory settings are assumed to be available, so psutil is only
+    # queried if more memory is requested
+    if memory <= 1024:
+        return memory
     free_ram = get_free_ram("MB", 100)
     if free_ram < memory:
         grass.warning(
@@ -309,6 +465,15 @@ def test_memory(memory_string):
         return memory
 
 
+def try_remove_mask():
+    """Remove the raster mask if one is active"""
+    if grass.find_file(name="MASK", element="cell")["file"]:
+        try:
+            grass.run_command("r.mask", flags="r", quiet=True)
+        except Exception:
+            pass
+
+
 def verify_mapsets(start_cur_mapset):
     """The function verifies the switches to the start_cur_mapset.
 
@@ -327,3 +492,14 @@ def verify_mapsets(start_cur_mapset):
         )
     location_path = os.path.join(gisdbase, location)
     return location_path
+
+
+def wait_for_commands(procs):
+    """Wait for GRASS modules started with grass.start_command and check
+    their return codes
+    Args:
+        procs (list): Processes of the started GRASS modules
+    """
+    for proc in procs:
+        if proc.wait() != 0:
+            grass.fatal(_(f"Module <{proc.args[0]}> failed"))
@@ -120,24 +120,23 @@ from grass.pygrass.utils import get_lib_path
 
 
 # initialize global vars
-rm_rasters = []
-rm_vectors = []
-rm_groups = []
+# common prefix of all temporary maps, so that they can be removed at once
+tmp_prefix = f"tmp_rex_{os.getpid()}"
 tmp_mask_old = None
+# minimum number of cells of a tile for which an image segmentation is done
+min_cells_segmentation = 100000
 
 
 def cleanup():
     nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="cell")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
-    for rmv in rm_vectors:
-        if grass.find_file(name=rmv, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
-    for rmgroup in rm_groups:
-        if grass.find_file(name=rmgroup, element="group")["file"]:
-            grass.run_command("g.remove", type="group", name=rmgroup, **kwargs)
+    grass.run_command(
+        "g.remove",
+        type="raster,vector,group",
+        pattern=f"{tmp_prefix}_*",
+        flags="f",
+        quiet=True,
+        stderr=nuldev,
+    )
     if grass.find_file(name="MASK", element="cell")["file"]:
         try:
             grass.run_command("r.mask", flags="r", quiet=True)
@@ -149,8 +148,10 @@ def cleanup():
 
 
 def extract_buildings(**kwargs):
-    from analyse_buildings_lib import get_bins
+    from analyse_buildings_lib import get_ndsm_transform_expression
+    from analyse_buildings_lib import get_percentile
     from analyse_buildings_lib import test_memory
+    from analyse_buildings_lib import wait_for_commands
 
     grass.message(_("Preparing input data..."))
     if grass.find_file(name="MASK", element="cell")["file"]:
@@ -166,33 +167,9 @@ def extract_buildings(**kwargs):
     output = kwargs["output"]
     user_min_size = kwargs["min_size"]
 
-    # rasterizing fnk vect
-    if "fnk_vector" in kwargs:
-        fnk_vect = kwargs["fnk_vector"]
-        fnk_column = kwargs["fnk_column"]
-
-        fnk_rast = f"fnk_rast_{os.getgid()}"
-        rm_rasters.append(fnk_rast)
-        grass.run_command(
-            "v.to.rast",
-            input=fnk_vect,
-            use="attr",
-            attribute_column=fnk_column,
-            output=fnk_rast,
-            quiet=True,
-        )
-    elif "fnk_raster" in kwargs:
-        fnk_rast = kwargs["fnk_raster"]
-
     # fnk-codes with potential tree growth (400+ = Vegetation)
     fnk_codes_trees = ["400", "410", "420", "431", "432", "441", "472"]
 
-    # create binary vegetation raster
-    veg_raster = f"vegetation_raster_{os.getpid()}"
-    rm_rasters.append(veg_raster)
-    veg_expression = f"{veg_raster} = if({ndvi}>{ndvi_thresh},1,0)"
-    grass.run_command("r.mapcalc", expression=veg_expression, quiet=True)
-
     # identifying ignored areas
     grass.message(
         _("Excluding land-use classes without potential buildings...")
@@ -201,8 +178,6 @@ def extract_buildings(**kwargs):
     # Lager f. Rohstoffe', Bahnanlagen, Flug- und Landeplätze (2x),
     # Freiflächen (2x), Abgrabungsflächen (3x), Friedhof (2x), Begleitgrün (3x),
     # Wasserflaechen (9x), Wiesen & Weiden (2x), Ackerflächen, Berghalden (2x)
-    non_dump_areas = f"non_dump_areas_{os.getpid()}"
-    rm_rasters.append(non_dump_areas)
     fnk_codes_dumps = [
         "62",
         "63",
@@ -246,61 +221,91 @@ def extract_buildings(**kwargs):
     if exclude_roads:
         fnk_codes_dumps.extend(fnk_codes_roads)
 
-    grass.run_command(
-        "r.null", map=fnk_rast, setnull=fnk_codes_dumps, quiet=True
-    )
-    exp_string = f"{non_dump_areas} = if(isnull({fnk_rast}), null(),1)"
-    grass.run_command("r.mapcalc", expression=exp_string, quiet=True)
+    # create a mask of areas with potential buildings
+    non_dump_areas = f"{tmp_prefix}_non_dump_areas"
+    if "fnk_vector" in kwargs:
+        # extract only the FNK polygons with potential buildings, so that
+        # the excluded polygons are not rasterized at all
+        fnk_vect = kwargs["fnk_vector"]
+        fnk_column = kwargs["fnk_column"]
+
+        fnk_vect_keep = f"{tmp_prefix}_fnk_vect_keep"
+        grass.run_command(
+            "v.extract",
+            input=fnk_vect,
+            output=fnk_vect_keep,
+            where=f"{fnk_column} NOT IN ({','.join(fnk_codes_dumps)})",
+            quiet=True,
+        )
+        grass.run_command(
+            "v.to.rast",
+            input=fnk_vect_keep,
+            use="val",
+            value=1,
+            output=non_dump_areas,
+            quiet=True,
+        )
+    elif "fnk_raster" in kwargs:
+        # reclassify FNK raster (the reclassified raster is virtual and
+        # needs no pass over the FNK raster)
+        fnk_rast = kwargs["fnk_raster"]
+        reclass_rules = f"{' '.join(fnk_codes_dumps)} = NULL\n* = 1\n"
+        grass.write_command(
+            "r.reclass",
+            input=fnk_rast,
+            output=non_dump_areas,
+            rules="-",
+            stdin=reclass_rules,
+            quiet=True,
+        )
 
     # ndsm buildings thresholds (for buildings with one and more stories)
     ndsm_thresh1 = 2.0
-    if flags["s"]:
+    segment = flags["s"]
+    if segment and grass.region()["cells"] < min_cells_segmentation:
+        grass.warning(
+            _(
+                "Tile is too small for image segmentation. Extracting "
+                "buildings without segmentation..."
+            )
+        )
+        segment = False
+    if segment:
         ####################
         # with segmentation
         ###################
         options["memory"] = test_memory(options["memory"])
+        # create binary vegetation raster (independent of the segmentation,
+        # so it is computed in the background)
+        veg_raster = f"{tmp_prefix}_vegetation_raster"
+        veg_expression = f"{veg_raster} = if({ndvi}>{ndvi_thresh},1,0)"
+        veg_proc = grass.start_command(
+            "r.mapcalc", expression=veg_expression, quiet=True
+        )
         # cut the nDSM
         # transform ndsm
         grass.message(_("nDSM Transformation..."))
-        ndsm_cut_tmp = f"ndsm_cut_tmp_{os.getpid()}"
-        rm_rasters.append(ndsm_cut_tmp)
-        ndsm_cut = f"ndsm_cut_{os.getpid()}"
-        rm_rasters.append(ndsm_cut)
+        ndsm_cut = f"{tmp_prefix}_ndsm_cut"
         # cut dtm extensively to also emphasize low buildings
-        percentiles = "5,50,95"
-        bins = get_bins()
-        perc_values_list = list(
-            grass.parse_command(
-                "r.quantile",
-                input=ndsm,
-                percentile=percentiles,
-                bins=bins,
-                quiet=True,
-            ).keys()
-        )
-        perc_values = [item.split(":")[2] for item in perc_values_list]
-        grass.message(_(f"perc values are {perc_values}"))
+        percentiles = [5, 50, 95]
+        perc_values = get_percentile(ndsm, percentiles)
+        grass.debug(f"perc values are {perc_values}")
         med = perc_values[1]
         p_low = perc_values[0]
         p_high = perc_values[2]
-        trans_expression = (
-            f"{ndsm_cut} = float(if({ndsm} >= {med}, sqrt(({ndsm} - "
-            f"{med}) / ({p_high} - {med})), -1.0 * "
-            f"sqrt(({med} - {ndsm}) / ({med} - "
-            f"{p_low}))))"
+        trans_expression = get_ndsm_transform_expression(
+            ndsm_cut, ndsm, p_low, med, p_high
         )
 
         grass.run_command("r.mapcalc", expression=trans_expression, quiet=True)
 
         grass.message(_("Image segmentation..."))
         # segmentation
-        seg_group = f"seg_group_{os.getpid()}"
-        rm_groups.append(seg_group)
+        seg_group = f"{tmp_prefix}_seg_group"
         grass.run_command(
             "i.group", group=seg_group, input=f"{ndsm_cut},{ndvi}", quiet=True
         )
-        segmented = f"segmented_{os.getpid()}"
-        rm_rasters.append(segmented)
+        segmented = f"{tmp_prefix}_segmented"
         grass.run_command(
             "i.segment",
             group=seg_group,
@@ -312,9 +317,9 @@ def extract_buildings(**kwargs):
         )
 
         grass.message(_("Extracting potential buildings..."))
-        ndsm_zonal_stats = f"ndsm_zonal_stats_{os.getpid()}"
-        rm_rasters.append(ndsm_zonal_stats)
-        grass.run_command(
+        # both zonal statistics are independent and computed in parallel
+        ndsm_zonal_stats = f"{tmp_prefix}_ndsm_zonal_stats"
+        ndsm_zonal_proc = grass.start_command(
             "r.stats.zonal",
             base=segmented,
             cover=ndsm,
@@ -322,9 +327,9 @@ def extract_buildings(**kwargs):
             output=ndsm_zonal_stats,
             quiet=True,
         )
-        veg_zonal_stats = f"veg_zonal_stats_{os.getpid()}"
-        rm_rasters.append(veg_zonal_stats)
-        grass.run_command(
+        wait_for_commands([veg_proc])
+        veg_zonal_stats = f"{tmp_prefix}_veg_zonal_stats"
+        veg_zonal_proc = grass.start_command(
             "r.stats.zonal",
             base=segmented,
             cover=veg_raster,
@@ -332,18 +337,15 @@ def extract_buildings(**kwargs):
             output=veg_zonal_stats,
             quiet=True,
         )
+        wait_for_commands([ndsm_zonal_proc, veg_zonal_proc])
 
         # extract building objects by: average nDSM height > 2m and
         # majority vote of vegetation pixels (implemented by average of binary
         # raster (mean < 0.5))
-        buildings_raw_rast = f"buildings_raw_rast_{os.getpid()}"
-        rm_rasters.append(buildings_raw_rast)
+        buildings_raw_rast = f"{tmp_prefix}_buildings_raw_rast"
         expression_building = (
             f"{buildings_raw_rast} = if({ndsm_zonal_stats}>{ndsm_thresh1} && "
-            f"{veg_zonal_stats}<0.5 && {non_dump_areas}==1,1,null())"
-        )
-        grass.run_command(
-            "r.mapcalc", expression=expression_building, quiet=True
+            f"{veg_zonal_stats}<0.5,1,null())"
         )
 
     else:
@@ -352,76 +354,67 @@ def extract_buildings(**kwargs):
         ######################
 
         grass.message(_("Extracting potential buildings..."))
-        buildings_raw_rast = f"buildings_raw_rast_{os.getpid()}"
-        rm_rasters.append(buildings_raw_rast)
+        buildings_raw_rast = f"{tmp_prefix}_buildings_raw_rast"
 
         expression_building = (
             f"{buildings_raw_rast} = if({ndsm}>{ndsm_thresh1} && "
-            f"{veg_raster}==0 && {non_dump_areas}==1,1,null())"
-        )
-        grass.run_command(
-            "r.mapcalc", expression=expression_building, quiet=True
+            f"{ndvi}<={ndvi_thresh},1,null())"
         )
 
+    # only evaluate the building expression in areas with potential
+    # buildings by setting the FNK mask
+    grass.run_command("r.mask", raster=non_dump_areas, quiet=True)
+    grass.run_command("r.mapcalc", expression=expression_building, quiet=True)
+    grass.run_command("r.mask", flags="r", quiet=True)
+
     # check if potential buildings have been detected
     warn_msg = "No potential buildings detected. Skipping..."
-    buildings_stats = grass.parse_command(
-        "r.univar", map=buildings_raw_rast, flags="g", quiet=True
+    # the range stored with the raster is sufficient (NULL for a raster
+    # without any buildings), so no pass over the raster is needed
+    buildings_range = grass.parse_command(
+        "r.info",
+        map=buildings_raw_rast,
+        flags="r",
+        quiet=True,
     )
-    if int(buildings_stats["n"]) == 0:
+    if buildings_range["min"] == "NULL":
         grass.warning(_(f"{warn_msg}"))
 
         return 0
 
-    # vectorize & filter
-    vector_tmp1 = f"buildings_vect_tmp1_{os.getpid()}"
-    rm_vectors.append(vector_tmp1)
-    vector_tmp2 = f"{output}"
-    rm_vectors.append(vector_tmp2)
-    grass.run_command(
-        "r.to.vect",
-        input=buildings_raw_rast,
-        output=vector_tmp1,
-        type="area",
-        quiet=True,
-    )
-
+    # filter by size in raster space, so that only the remaining buildings
+    # are vectorized
     grass.message(_("Filtering buildings by size..."))
-    area_col = "area_sqm"
+    buildings_rast = f"{tmp_prefix}_buildings_rast"
     min_size = float(user_min_size) / 2
     grass.run_command(
-        "v.to.db",
-        map=vector_tmp1,
-        option="area",
-        columns=area_col,
-        units="meters",
+        "r.reclass.area",
+        input=buildings_raw_rast,
+        output=buildings_rast,
+        # r.reclass.area expects the size in hectares
+        value=min_size / 10000,
+        mode="greater",
         quiet=True,
     )
 
+    # vectorize (without attribute table, it is created after merging the
+    # tiles)
+    vector_tmp = f"{output}"
     grass.run_command(
-        "v.db.droprow",
-        input=vector_tmp1,
-        output=vector_tmp2,
-        where=f"{area_col}<{min_size}",
+        "r.to.vect",
+        input=buildings_rast,
+        output=vector_tmp,
+        type="area",
+        flags="t",
         quiet=True,
     )
 
-    # check if potential buildings remain
-    db_connection = grass.parse_command(
-        "v.db.connect", map=vector_tmp2, flags="p", quiet=True
-    )
-    if not db_connection:
-        grass.warning(_(f"{warn_msg}"))
-
-        return 0
-
-    vector_tmp1_feat = grass.parse_command(
-        "v.db.select", map=vector_tmp1, column="cat", flags="c", quiet=True
-    )
-    vector_tmp2_feat = grass.parse_command(
-        "v.db.select", map=vector_tmp2, column="cat", flags="c", quiet=True
+    # check if potential buildings remain (the topology counts are
+    # sufficient, the attribute table does not need to be read)
+    vector_tmp_topo = grass.parse_command(
+        "v.info", map=vector_tmp, flags="t", quiet=True
     )
-    if len(vector_tmp1_feat.keys()) == 0 or len(vector_tmp2_feat.keys()) == 0:
+    if int(vector_tmp_topo["centroids"]) == 0:
         grass.warning(_(f"{warn_msg}"))
 
         return 0
@@ -430,7 +423,7 @@ def extract_buildings(**kwargs):
 
 
 def main():
-    global rm_rasters, tmp_mask_old, rm_vectors, rm_groups
+    global tmp_mask_old
 
     path = get_lib_path(
         modname="m.analyse.buildings", libname="analyse_buildings_lib"
@@ -459,7 +452,7 @@ def main():
     elif options["fnk_raster"]:
         fnk_rast = options["fnk_raster"].split("@")[0]
 
-    grass.message(_(f"Applying building extraction to region {area}..."))
+    grass.verbose(_(f"Applying building extraction to region {area}..."))
 
     # switch to another mapset for parallel processing
     gisrc, newgisrc, old_mapset = switch_to_new_mapset(new_mapset)
@@ -468,10 +461,8 @@ def main():
     ndsm += f"@{old_mapset}"
     ndvi += f"@{old_mapset}"
     if options["fnk_vector"]:
-        fnk_name = fnk_vect
         fnk_vect += f"@{old_mapset}"
     if options["fnk_raster"]:
-        fnk_name = fnk_rast
         fnk_rast += f"@{old_mapset}"
 
     grass.run_command(
@@ -480,7 +471,9 @@ def main():
         align=ndsm,
         quiet=True,
     )
-    grass.message(_(f"Current region (Tile: {area}):\n{grass.region()}"))
+    # grass.region() spawns a subprocess, so only print it in verbose mode
+    if grass.verbosity() >= 3:
+        grass.verbose(_(f"Current region (Tile: {area}):\n{grass.region()}"))
 
     # check input data (nDSM and NDVI)
     ndsm_stats = grass.parse_command(
@@ -501,20 +494,6 @@ def main():
 
         return 0
 
-    # copy FNK to temporary mapset
-    if options["fnk_vector"]:
-        fnk_vect_tmp = f"{fnk_name}_{os.getpid()}"
-        rm_vectors.append(fnk_vect_tmp)
-        grass.run_command(
-            "g.copy", vector=f"{fnk_vect},{fnk_vect_tmp}", quiet=True
-        )
-    elif options["fnk_raster"]:
-        fnk_rast_tmp = f"{fnk_name}_{os.getpid()}"
-        rm_rasters.append(fnk_rast_tmp)
-        grass.run_command(
-            "g.copy", raster=f"{fnk_rast},{fnk_rast_tmp}", quiet=True
-        )
-
     # start building extraction
     kwargs = {
         "output": output,
@@ -529,10 +508,10 @@ def main():
     if flags["s"]:
         kwargs["flags"] = "s"
     if options["fnk_vector"]:
-        kwargs["fnk_vector"] = fnk_vect_tmp
+        kwargs["fnk_vector"] = fnk_vect
         kwargs["fnk_column"] = fnk_column
     elif options["fnk_raster"]:
-        kwargs["fnk_raster"] = fnk_rast_tmp
+        kwargs["fnk_raster"] = fnk_rast
 
     # run building_extraction
     extract_buildings(**kwargs)
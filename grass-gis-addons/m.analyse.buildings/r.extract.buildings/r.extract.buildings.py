@@ -155,6 +155,7 @@ rm_rasters = []
 rm_vectors = []
 rm_groups = []
 rm_dirs = []
+rm_tables = []
 tmp_mask_old = None
 orig_region = None
 
@@ -162,18 +163,23 @@ orig_region = None
 def cleanup():
     nuldev = open(os.devnull, "w")
     kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="cell")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
-    for rmv in rm_vectors:
-        if grass.find_file(name=rmv, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
-    for rmgroup in rm_groups:
-        if grass.find_file(name=rmgroup, element="group")["file"]:
-            grass.run_command("g.remove", type="group", name=rmgroup, **kwargs)
+    # g.remove ignores not existing maps, so all maps of a type are removed
+    # at once without checking their existence first
+    for rm_type, rm_list in (
+        ("raster", rm_rasters),
+        ("vector", rm_vectors),
+        ("group", rm_groups),
+    ):
+        if rm_list:
+            grass.run_command(
+                "g.remove", type=rm_type, name=",".join(rm_list), **kwargs
+            )
     for rmdir in rm_dirs:
         if os.path.isdir(rmdir):
             shutil.rmtree(rmdir)
+    for rmtable in rm_tables:
+        remove_table_str = f"DROP TABLE IF EXISTS {rmtable}"
+        grass.run_command("db.execute", sql=remove_table_str)
     if orig_region is not None:
         if grass.find_file(name=orig_region, element="windows")["file"]:
             grass.run_command("g.region", region=orig_region)
@@ -191,7 +197,8 @@ def cleanup():
 
 
 def main():
-    global rm_rasters, tmp_mask_old, rm_vectors, rm_groups, rm_dirs, orig_region
+    global rm_rasters, tmp_mask_old, rm_vectors, rm_groups, rm_dirs, rm_tables
+    global orig_region
 
     path = get_lib_path(
         modname="m.analyse.buildings", libname="analyse_buildings_lib"
@@ -201,9 +208,12 @@ def main():
     sys.path.append(path)
     try:
         from analyse_buildings_lib import (
+            add_area_fd_columns,
             create_grid,
-            get_bins,
+            get_ndsm_transform_expression,
+            get_nprocs_kwargs,
             get_percentile,
+            insert_rows,
             set_nprocs,
             test_memory,
             verify_mapsets,
@@ -267,15 +277,15 @@ def main():
     # save current mapset
     start_cur_mapset = grass.gisenv()["MAPSET"]
 
-    # test nprocs setting
-    if number_tiles < nprocs:
-        nprocs = number_tiles
-    queue = ParallelModuleQueue(nprocs=nprocs)
+    # test nprocs setting (all nprocs are used again for the
+    # multithreaded modules after the tile processing)
+    nprocs_tiles = min(nprocs, number_tiles)
+    queue = ParallelModuleQueue(nprocs=nprocs_tiles)
     output_list = list()
 
     # divide memory
     options["memory"] = test_memory(options["memory"])
-    memory = int(int(options["memory"]) / nprocs)
+    memory = int(int(options["memory"]) / nprocs_tiles)
 
     # Loop over tiles_list
     gisenv = grass.gisenv()
@@ -428,29 +438,16 @@ def main():
         grass.run_command(
             "g.copy", vector=f"{output_list[0]},{buildings_cats}", quiet=True
         )
+        # the tile outputs are created without attribute table
+        grass.run_command("v.db.addtable", map=buildings_cats, quiet=True)
 
     # filter by shape and size
     grass.message(_("Filtering buildings by shape and size..."))
     area_col = "area_sqm"
     fd_col = "fractal_d"
-    grass.run_command(
-        "v.to.db",
-        map=buildings_cats,
-        option="area",
-        columns=area_col,
-        units="meters",
-        quiet=True,
-        overwrite=True,
-    )
-    grass.run_command(
-        "v.to.db",
-        map=buildings_cats,
-        option="fd",
-        columns=fd_col,
-        units="meters",
-        quiet=True,
-        overwrite=True,
-    )
+    temp_table = f"buildings_area_fd_table_{os.getpid()}"
+    rm_tables.append(temp_table)
+    add_area_fd_columns(buildings_cats, area_col, fd_col, temp_table)
 
     buildings_cleaned = f"buildings_cleaned_{os.getpid()}"
     rm_vectors.append(buildings_cleaned)
@@ -481,28 +478,18 @@ def main():
     options["memory"] = test_memory(options["memory"])
     grass.run_command("r.mask", vector=buildings_cleaned_filled, quiet=True)
 
-    percentiles = "1,50,99"
-    bins = get_bins()
-    quants_raw = list(
-        grass.parse_command(
-            "r.quantile",
-            percentiles=percentiles,
-            input=ndsm,
-            bins=bins,
-            quiet=True,
-        ).keys()
-    )
-    quants = [item.split(":")[2] for item in quants_raw]
+    # the percentiles are computed under the buildings mask, so they
+    # differ from the per-tile percentiles of the workers
+    percentiles = [1, 50, 99]
+    quants = get_percentile(ndsm, percentiles)
     grass.message(_(f'The percentiles are: {(", ").join(quants)}'))
     trans_ndsm_mask = f"ndsm_buildings_transformed_{os.getpid()}"
     rm_rasters.append(trans_ndsm_mask)
     med = quants[1]
     p_low = quants[0]
     p_high = quants[2]
-    trans_expression = (
-        f"{trans_ndsm_mask} = float(if({ndsm} >= {med}, sqrt(({ndsm} - "
-        f"{med}) / ({p_high} - {med})), -1.0 * sqrt(({med} - {ndsm}) / "
-        f"({med} - {p_low}))))"
+    trans_expression = get_ndsm_transform_expression(
+        trans_ndsm_mask, ndsm, p_low, med, p_high
     )
 
     grass.run_command("r.mapcalc", expression=trans_expression, quiet=True)
@@ -524,6 +511,7 @@ def main():
         memory=options["memory"],
         minsize=400,
         quiet=True,
+        **get_nprocs_kwargs("i.segment", nprocs),
     )
 
     grass.run_command("r.mask", flags="r", quiet=True)
@@ -545,23 +533,10 @@ def main():
     grass.message(_("Filtering buildings by shape and size..."))
     area_col = "area_sqm"
     fd_col = "fractal_d"
-    grass.run_command(
-        "v.to.db",
-        map=segmented_ndsm_buildings_vect,
-        option="area",
-        columns=area_col,
-        units="meters",
-        quiet=True,
-        overwrite=True,
-    )
-    grass.run_command(
-        "v.to.db",
-        map=segmented_ndsm_buildings_vect,
-        option="fd",
-        columns=fd_col,
-        units="meters",
-        quiet=True,
-        overwrite=True,
+    temp_table = f"seg_buildings_area_fd_table_{os.getpid()}"
+    rm_tables.append(temp_table)
+    add_area_fd_columns(
+        segmented_ndsm_buildings_vect, area_col, fd_col, temp_table
     )
 
     grass.run_command(
@@ -576,73 +551,84 @@ def main():
     grass.message(_("Extracting building height statistics..."))
     av_story_height = 3.0
     col_prefix = "ndsm"
+    # rasterize the buildings once and compute all statistics in a single
+    # r.univar pass over the nDSM instead of using v.rast.stats
+    building_zones = f"building_zones_{os.getpid()}"
+    rm_rasters.append(building_zones)
     grass.run_command(
-        "v.rast.stats",
-        map=output_vect,
-        raster=ndsm,
-        method=("minimum,maximum,average,stddev,median,percentile"),
-        percentile=95,
-        column_prefix=col_prefix,
-        quiet=True,
-    )
-    # rename columns to shorter names
-    min_col = f"{col_prefix}_min"
-    max_col = f"{col_prefix}_max"
-    av_col = f"{col_prefix}_av"
-    stddev_col = f"{col_prefix}_sd"  #
-    median_col = f"{col_prefix}_med"
-    perc_col = f"{col_prefix}_p95"
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output_vect,
-        column=f"{col_prefix}_minimum,{min_col}",
-        quiet=True,
-    )
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output_vect,
-        column=f"{col_prefix}_maximum,{max_col}",
-        quiet=True,
-    )
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output_vect,
-        column=f"{col_prefix}_average,{av_col}",
-        quiet=True,
-    )
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output_vect,
-        column=f"{col_prefix}_stddev,{stddev_col}",
+        "v.to.rast",
+        input=output_vect,
+        use="cat",
+        output=building_zones,
         quiet=True,
     )
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output_vect,
-        column=f"{col_prefix}_median,{median_col}",
+    zonal_stats = grass.read_command(
+        "r.univar",
+        map=ndsm,
+        zones=building_zones,
+        percentile=95,
+        separator="pipe",
+        flags="te",
         quiet=True,
+        **get_nprocs_kwargs("r.univar", nprocs),
+    ).splitlines()
+    # output columns and the r.univar statistics they are filled with
+    stats_columns = {
+        f"{col_prefix}_min": "min",
+        f"{col_prefix}_max": "max",
+        f"{col_prefix}_av": "mean",
+        f"{col_prefix}_sd": "stddev",
+        f"{col_prefix}_med": "median",
+        f"{col_prefix}_p95": "perc_95",
+    }
+    perc_col = f"{col_prefix}_p95"
+    header = zonal_stats[0].split("|")
+    stats_idx = [header.index(stat) for stat in stats_columns.values()]
+
+    # it is faster to create a table, fill it, and join tables than using
+    # v.db.update for each building cat
+    temp_table = f"buildings_stats_table_{os.getpid()}"
+    rm_tables.append(temp_table)
+    columns_str = ", ".join(f"{col} double precision" for col in stats_columns)
+    create_table_str = (
+        f"CREATE TABLE {temp_table} (cat integer, {columns_str})"
     )
+    grass.run_command("db.execute", sql=create_table_str)
+    rows = []
+    for line in zonal_stats[1:]:
+        stats = line.split("|")
+        rows.append(
+            [stats[0]]
+            + [
+                stats[idx] if stats[idx] not in ("nan", "-nan") else "NULL"
+                for idx in stats_idx
+            ]
+        )
+    insert_rows(temp_table, ["cat", *stats_columns], rows)
     grass.run_command(
-        "v.db.renamecolumn",
+        "v.db.join",
         map=output_vect,
-        column=f"{col_prefix}_percentile_95,{perc_col}",
+        column="cat",
+        other_table=temp_table,
+        other_column="cat",
         quiet=True,
     )
 
     # calculate stories
     column_etagen = "floors"
-    grass.run_command(
-        "v.db.addcolumn",
-        map=output_vect,
-        columns=f"{column_etagen} INT",
-        quiet=True,
+    # add and fill the column with one db.execute call
+    db_info = grass.vector_db(output_vect)[1]
+    sql_string = (
+        f"ALTER TABLE {db_info['table']} ADD COLUMN {column_etagen} INT;\n"
+        f"UPDATE {db_info['table']} SET {column_etagen} = "
+        f"ROUND({perc_col}/{av_story_height},0);\n"
     )
-    sql_string = f"ROUND({perc_col}/{av_story_height},0)"
-    grass.run_command(
-        "v.db.update",
-        map=output_vect,
-        column=column_etagen,
-        query_column=sql_string,
+    grass.write_command(
+        "db.execute",
+        input="-",
+        stdin=sql_string,
+        database=db_info["database"],
+        driver=db_info["driver"],
         quiet=True,
     )
 
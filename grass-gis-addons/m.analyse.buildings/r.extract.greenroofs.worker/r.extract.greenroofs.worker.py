@@ -151,6 +151,7 @@ import os
 import sys
 
 import grass.script as grass
+import numpy as np
 from grass.pygrass.utils import get_lib_path
 
 # initialize global vars
@@ -165,23 +166,16 @@ bn_thresh = 80
 ndsm_thresh = 2
 
 
-def try_remove_mask():
-    if grass.find_file(name="MASK", element="cell")["file"]:
-        try:
-            grass.run_command("r.mask", flags="r", quiet=True)
-        except Exception:
-            pass
-
-
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="cell")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
-    for rmv in rm_vectors:
-        if grass.find_file(name=rmv, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
+    try:
+        from analyse_buildings_lib import (
+            remove_temporary_maps,
+            try_remove_mask,
+        )
+    except ImportError:
+        # library not found, so no temporary data has been created
+        return
+    remove_temporary_maps(rm_rasters, rm_vectors, rm_groups)
     try_remove_mask()
 
 
@@ -212,7 +206,11 @@ def main():
         grass.fatal("Unable to find the analyse buildings library directory")
     sys.path.append(path)
     try:
-        from analyse_buildings_lib import switch_to_new_mapset
+        from analyse_buildings_lib import (
+            get_ndsm_transform_expression,
+            switch_to_new_mapset,
+            wait_for_commands,
+        )
     except Exception:
         grass.fatal("m.analyse.buildings library is not installed")
 
@@ -273,10 +271,8 @@ def main():
         p_high = options["ndsm_p_high"]
         ndsm_cut = f"ndsm_cut_{num}"
         rm_rasters.append(ndsm_cut)
-        trans_expression = (
-            f"{ndsm_cut} = float(if({ndsm} >= {med},"
-            f"sqrt(({ndsm} - {med}) / ({p_high} - {med})),"
-            f"-1.0 * sqrt(({med} - {ndsm}) / ({med} - {p_low}))))"
+        trans_expression = get_ndsm_transform_expression(
+            ndsm_cut, ndsm, p_low, med, p_high
         )
         grass.run_command("r.mapcalc", expression=trans_expression, quiet=True)
 
@@ -284,8 +280,16 @@ def main():
         seg_group = f"seg_group_{num}"
         rm_groups.append(seg_group)
         group_inp = []
-        for rast in [ndsm_cut, green_blue_ratio, ndvi]:
-            rast_stats = grass.parse_command("r.univar", map=rast, flags="g")
+        # check the rasters in parallel for usable values
+        univar_procs = {
+            rast: grass.pipe_command("r.univar", map=rast, flags="g")
+            for rast in [ndsm_cut, green_blue_ratio, ndvi]
+        }
+        for rast, proc in univar_procs.items():
+            stdout = proc.communicate()[0]
+            if proc.returncode != 0:
+                grass.fatal(_(f"Module <r.univar> failed for {rast}"))
+            rast_stats = grass.parse_key_val(grass.decode(stdout))
             if (
                 rast_stats["min"] != rast_stats["max"]
                 and rast_stats["min"] != "nan"
@@ -327,16 +331,22 @@ def main():
             red_green_ratio: rgr_average_seg,
             brightness: brightness_average_seg,
         }
+        # the zonal statistics are independent of each other, so they are
+        # calculated in parallel
+        zonal_procs = []
         for cover, output_rast in stat_rasts.items():
             rm_rasters.append(output_rast)
-            grass.run_command(
-                "r.stats.zonal",
-                base=segmented,
-                cover=cover,
-                method="average",
-                output=output_rast,
-                quiet=True,
+            zonal_procs.append(
+                grass.start_command(
+                    "r.stats.zonal",
+                    base=segmented,
+                    cover=cover,
+                    method="average",
+                    output=output_rast,
+                    quiet=True,
+                )
             )
+        wait_for_commands(zonal_procs)
 
     grass.message(_("Roof vegetation extraction..."))
     # red green ratio to eliminate very red roofs
@@ -373,12 +383,36 @@ def main():
         )
         return
 
+    # remove small clumps already in raster space, so that less polygons have
+    # to be vectorized and overlaid (the exact area is checked after the
+    # overlay with the building outlines)
+    pot_veg_rast_large = f"pot_veg_rast_large_{num}"
+    rm_rasters.append(pot_veg_rast_large)
+    grass.run_command(
+        "r.reclass.area",
+        input=pot_veg_rast,
+        output=pot_veg_rast_large,
+        # r.reclass.area expects the size in hectares
+        value=min_veg_size / 10000,
+        mode="greater",
+        quiet=True,
+    )
+    pot_veg_rast_large_range = grass.parse_command(
+        "r.info", map=pot_veg_rast_large, flags="r"
+    )
+    if pot_veg_rast_large_range["min"] == "NULL":
+        print(
+            f"r.extract.greenroofs.worker skipped for buildings in tile {num}:"
+            " No large enough potential vegetation areas found."
+        )
+        return
+
     # vectorize segments
     segments_vect = f"segments_vect_{num}"
     rm_vectors.append(segments_vect)
     grass.run_command(
         "r.to.vect",
-        input=pot_veg_rast,
+        input=pot_veg_rast_large,
         output=segments_vect,
         type="area",
         quiet=True,
@@ -443,155 +477,150 @@ def main():
         quiet=True,
     )
 
-    grass.message("Select buildings with vegetation ...")
-    # select buildings with vegetation cover (note: there may be too many
-    # objects in the result vector, but the column in pot_veg_areas contains
-    # the correct building ID)
-    bu_with_veg = f"bu_with_veg_{os.getpid()}"
-    rm_vectors.append(bu_with_veg)
-    grass.run_command(
-        "v.select",
-        ainput=building_outlines,
-        binput=pot_veg_areas,
-        operator="overlap",
-        output=bu_with_veg,
-        quiet=True,
-    )
-
-    # vegetation from rest of buildings and dissolve per building
-    # to get ndsm statistics of remaining roof
-    bu_with_veg_rest = f"bu_with_veg_rest_{num}"
-    rm_vectors.append(bu_with_veg_rest)
-    grass.run_command(
-        "v.overlay",
-        ainput=bu_with_veg,
-        binput=pot_veg_areas,
-        operator="not",
-        output=bu_with_veg_rest,
-        quiet=True,
+    grass.message("Calculate statistics of remaining roofs ...")
+    # rasterize the buildings without the vegetation areas to get the size
+    # and the ndsm statistic of the roof part that is not covered by
+    # vegetation in one raster pass, instead of overlaying and dissolving
+    # the vector maps
+    pot_veg_areas_rast = f"pot_veg_areas_rast_{num}"
+    bu_outlines_rast = f"bu_outlines_rast_{num}"
+    bu_rest_rast = f"bu_rest_rast_{num}"
+    rm_rasters.extend([pot_veg_areas_rast, bu_outlines_rast, bu_rest_rast])
+    wait_for_commands(
+        [
+            grass.start_command(
+                "v.to.rast",
+                input=pot_veg_areas,
+                output=pot_veg_areas_rast,
+                use="val",
+                value=1,
+                quiet=True,
+            ),
+            grass.start_command(
+                "v.to.rast",
+                input=building_outlines,
+                output=bu_outlines_rast,
+                use="cat",
+                quiet=True,
+            ),
+        ]
     )
-    bu_with_veg_rest_diss = f"bu_with_veg_rest_diss_{num}"
-    rm_vectors.append(bu_with_veg_rest_diss)
     grass.run_command(
-        "v.dissolve",
-        input=bu_with_veg_rest,
-        output=bu_with_veg_rest_diss,
-        column="a_cat",
+        "r.mapcalc",
+        expression=(
+            f"{bu_rest_rast} = if(isnull({pot_veg_areas_rast}), "
+            f"{bu_outlines_rast}, null())"
+        ),
         quiet=True,
     )
-
-    # get size of roof part that is not covered by vegetation
-    grass.run_command("v.db.addtable", map=bu_with_veg_rest_diss, quiet=True)
-
-    bu_rest_size_col = "bu_rest_size"
-    grass.run_command(
-        "v.to.db",
-        map=bu_with_veg_rest_diss,
-        option="area",
-        columns=bu_rest_size_col,
-        quiet=True,
-    )
-
-    # get ndsm average of roof part that is not covered by vegetation
-    grass.run_command(
-        "v.rast.stats",
-        map=bu_with_veg_rest_diss,
-        raster=ndsm,
-        method=method,
+    rest_stats = grass.read_command(
+        "r.univar",
+        map=ndsm,
+        zones=bu_rest_rast,
         percentile=percentile,
-        column_prefix="bu_ndsm",
+        separator="pipe",
+        flags="te",
         quiet=True,
-    )
+    ).splitlines()
+    region = grass.region()
+    cell_area = region["nsres"] * region["ewres"]
+    header = rest_stats[0].split("|")
+    zone_idx = header.index("zone")
+    non_null_idx = header.index("non_null_cells")
+    null_idx = header.index("null_cells")
+    perc_idx = header.index(f"perc_{percentile}")
+    # size and ndsm statistic of the remaining roof per building cat
+    bu_rest_stats = {}
+    for line in rest_stats[1:]:
+        stats = line.split("|")
+        num_cells = int(stats[non_null_idx]) + int(stats[null_idx])
+        bu_rest_stats[int(stats[zone_idx])] = (
+            num_cells * cell_area,
+            float(stats[perc_idx]),
+        )
 
-    # Only if no tree layer is given:
-    # compare statistics of potential areas with surrounding areas
-    # (e.g. to remove overlapping trees by height difference)
-    # add bu_ndsm_stat as column to vegetation layer
-    # remove potential vegetation polygons where difference between building
-    # height average and vegetation height average is too high
-    grass.run_command(
-        "v.db.join",
+    col_str = f"cat,a_cat,{seg_size_col},veg_ndsm_{method}_{percentile}"
+    table_proc = grass.pipe_command(
+        "v.db.select",
         map=pot_veg_areas,
-        column="a_cat",
-        other_table=bu_with_veg_rest_diss,
-        other_column="cat",
-        subset_columns=f"bu_ndsm_{method}_{percentile},{bu_rest_size_col}",
-        quiet=True,
-    )
-    col_str = (
-        f"cat,a_cat,{seg_size_col},{bu_rest_size_col},"
-        f"veg_ndsm_{method}_{percentile},bu_ndsm_{method}_{percentile}"
-    )
-    table = list(
-        grass.parse_command(
-            "v.db.select", map=pot_veg_areas, columns=col_str, flags="c"
-        ).keys()
+        columns=col_str,
+        separator="pipe",
+        flags="c",
     )
 
     trees = flags["t"]
     prop_thresh = 0.75
     diff_thresh = 1.5
 
-    building_dicts = []
-    for item in table:
-        # skip rows with empty entries
-        if not any([True for t in item.split("|") if len(t) == 0]):
-            cat = item.split("|")[0]
-            building_cat = item.split("|")[1]
-            seg_size = float(item.split("|")[2])
-            bu_rest_size = float(item.split("|")[3])
-            veg_ndsm_stat = float(item.split("|")[4])
-            bu_ndsm_stat = float(item.split("|")[5])
-            # assumption: potential vegetation areas that cover large proportion
-            # of underlying building are not trees
-            # therefore proportion is checked before ndsm difference check
-            # ndsm difference check only for small proportions (likely trees)
-            # NOTE: This is only applied if no external tree layer is given
-            building_dict = {
-                "building_cat": building_cat,
-                "seg_cat": cat,
-                "seg_size": seg_size,
-                "bu_rest_size": bu_rest_size,
-            }
-            if trees:
-                building_dicts.append(building_dict)
-            else:
-                if seg_size / (seg_size + bu_rest_size) >= prop_thresh:
-                    building_dicts.append(building_dict)
-                else:
-                    if veg_ndsm_stat - bu_ndsm_stat <= diff_thresh:
-                        building_dicts.append(building_dict)
+    # stream the whole table into one array, empty entries are read as nan
+    # (the table is not empty, as there is at least one vegetation area)
+    num_cols = len(col_str.split(","))
+    table_arr = np.genfromtxt(
+        table_proc.stdout, delimiter="|", dtype=float
+    ).reshape(-1, num_cols)
+    if table_proc.wait() != 0:
+        grass.fatal(_("Module <v.db.select> failed"))
+    # add size and ndsm statistic of the remaining roof, which are nan for
+    # buildings completely covered by vegetation
+    bu_rest_arr = np.array(
+        [
+            bu_rest_stats.get(building_cat, (np.nan, np.nan))
+            for building_cat in table_arr[:, 1]
+        ]
+    ).reshape(-1, 2)
+    table_arr = np.hstack((table_arr, bu_rest_arr))
+    # skip rows with empty entries
+    table_arr = table_arr[~np.isnan(table_arr).any(axis=1)]
+    seg_cats = table_arr[:, 0].astype(int)
+    building_cats = table_arr[:, 1].astype(int)
+    seg_sizes = table_arr[:, 2]
+    veg_ndsm_stats = table_arr[:, 3]
+    bu_rest_sizes = table_arr[:, 4]
+    bu_ndsm_stats = table_arr[:, 5]
+    # assumption: potential vegetation areas that cover large proportion
+    # of underlying building are not trees
+    # therefore proportion is checked before ndsm difference check
+    # ndsm difference check only for small proportions (likely trees)
+    # NOTE: This is only applied if no external tree layer is given
+    if trees:
+        keep = np.ones(len(seg_cats), dtype=bool)
+    else:
+        keep = (seg_sizes / (seg_sizes + bu_rest_sizes) >= prop_thresh) | (
+            veg_ndsm_stats - bu_ndsm_stats <= diff_thresh
+        )
 
     # check proportion of total vegetation area per building (not individual
-    # vegetation elements)
-    res_list = []
-    veg_list = []
-    unique_bu_cats = list(
-        set([item["building_cat"] for item in building_dicts])
+    # vegetation elements): sum up the vegetation sizes per building in one
+    # pass, the size of the remaining roof is the same for all segments of a
+    # building
+    unique_bu_cats, bu_idx = np.unique(
+        building_cats[keep], return_inverse=True
+    )
+    total_veg_sizes = np.bincount(bu_idx, weights=seg_sizes[keep])
+    bu_rest_size_per_bu = np.zeros(len(unique_bu_cats))
+    bu_rest_size_per_bu[bu_idx] = bu_rest_sizes[keep]
+    proportions = (
+        total_veg_sizes / (bu_rest_size_per_bu + total_veg_sizes) * 100
+    )
+    passing = proportions >= min_veg_proportion
+    res_list = [
+        {"building_cat": int(building_cat), "proportion": float(proportion)}
+        for building_cat, proportion in zip(
+            unique_bu_cats[passing], proportions[passing]
+        )
+    ]
+    # unique and sorted vegetation cats as comma separated string
+    veg_cats = ",".join(
+        map(str, np.unique(seg_cats[keep][passing[bu_idx]]).tolist())
     )
-    for building_cat in unique_bu_cats:
-        unique_segs = [
-            item
-            for item in building_dicts
-            if item["building_cat"] == building_cat
-        ]
-        bu_rest_size = unique_segs[0]["bu_rest_size"]
-        total_veg_size = sum([item["seg_size"] for item in unique_segs])
-        seg_cats = [item["seg_cat"] for item in unique_segs]
-        proportion = total_veg_size / (bu_rest_size + total_veg_size) * 100
-        if proportion >= min_veg_proportion:
-            res_list.append(
-                {"building_cat": building_cat, "proportion": proportion}
-            )
-            veg_list.extend(seg_cats)
 
-    if len(veg_list) > 0:
+    if len(veg_cats) > 0:
         # save vegetation areas without attributes
         grass.run_command(
             "v.extract",
             input=pot_veg_areas,
             output=output_vegetation,
-            cats=veg_list,
+            cats=veg_cats,
             flags="t",
             quiet=True,
         )
@@ -196,6 +196,7 @@ from grass.pygrass.utils import get_lib_path
 import re
 
 # initialize global vars
+pid = os.getpid()
 rm_rasters = []
 rm_vectors = []
 rm_groups = []
@@ -254,41 +255,41 @@ def calculate_auxiliary_datasets_and_brightness(red, green, blue):
     """
     grass.message(_("Calculating auxiliary datasets..."))
     # GB-ratio
-    green_blue_ratio = f"green_blue_ratio_{os.getpid()}"
+    green_blue_ratio = f"green_blue_ratio_{pid}"
     rm_rasters.append(green_blue_ratio)
     gb_expression = (
         f"{green_blue_ratio} = round(255*(1.0+"
         f"(float({green}-{blue})/({green}+{blue})))/2)"
     )
-    grass.run_command(
-        r_mapcalc_cmd,
-        expression=gb_expression,
-        quiet=True,
-        **mapcalc_tiled_kwargs,
-    )
     # RG_ratio
-    red_green_ratio = f"red_green_ratio_{os.getpid()}"
+    red_green_ratio = f"red_green_ratio_{pid}"
     rm_rasters.append(red_green_ratio)
     rg_expression = (
         f"{red_green_ratio} = round(255*(1.0+"
         f"(float({red}-{green})/({red}+{green})))/2)"
     )
-    grass.run_command(
-        r_mapcalc_cmd,
-        expression=rg_expression,
-        quiet=True,
-        **mapcalc_tiled_kwargs,
-    )
     # brightness
-    brightness = f"brightness_{os.getpid()}"
+    brightness = f"brightness_{pid}"
     rm_rasters.append(brightness)
     bn_expression = f"{brightness} = ({red}+{green})/2"
-    grass.run_command(
-        r_mapcalc_cmd,
-        expression=bn_expression,
-        quiet=True,
-        **mapcalc_tiled_kwargs,
-    )
+    expressions = [gb_expression, rg_expression, bn_expression]
+    if r_mapcalc_cmd == "r.mapcalc":
+        # calculate all three maps in one pass, so that the red, green and
+        # blue bands are read only once
+        grass.run_command(
+            r_mapcalc_cmd,
+            expression="\n".join(expressions),
+            quiet=True,
+        )
+    else:
+        # r.mapcalc.tiled supports only one output map per expression
+        for expression in expressions:
+            grass.run_command(
+                r_mapcalc_cmd,
+                expression=expression,
+                quiet=True,
+                **mapcalc_tiled_kwargs,
+            )
     return green_blue_ratio, red_green_ratio, brightness
 
 
@@ -306,26 +307,22 @@ def calculate_gb_threshold(green_blue_ratio, fnk_vect, gb_perc):
         grass.fatal("m.analyse.buildings library is not installed")
     # rasterizing fnk vector with fnk-codes with green areas
     # (gardens, parks, meadows) (not parallel)
-    fnk_rast = f"fnk_rast_{os.getpid()}"
+    fnk_rast = f"fnk_rast_{pid}"
     rm_rasters.append(fnk_rast)
     col = options["fnk_column"]
-    fnk_codes_green = [
-        f"{col}='271'",
-        f"{col}='272'",
-        f"{col}='273'",
-        f"{col}='361'",
-    ]
+    fnk_codes_green = ["'271'", "'272'", "'273'", "'361'"]
     grass.run_command(
         "v.to.rast",
         input=fnk_vect,
         use="val",
         value=1,
         output=fnk_rast,
-        where=" or ".join(fnk_codes_green),
+        where=f"{col} IN ({','.join(fnk_codes_green)})",
         memory=options["memory"],
         quiet=True,
     )
-    # set MASK
+    # set MASK by renaming the rasterized FNK map, so no additional raster
+    # (e.g. a masked copy of the GB-ratio) has to be written
     grass.run_command("g.rename", raster=f"{fnk_rast},MASK", quiet=True)
     # get GB statistics
     gb_percentile = float(gb_perc)
@@ -344,7 +341,7 @@ def create_building_mask(building_outlines, trees):
     global rm_rasters, rm_vectors
     # create MASK
     if trees:
-        buildings_clipped = f"buildings_clipped_{os.getpid()}"
+        buildings_clipped = f"buildings_clipped_{pid}"
         rm_vectors.append(buildings_clipped)
         grass.run_command(
             "v.overlay",
@@ -359,7 +356,7 @@ def create_building_mask(building_outlines, trees):
     else:
         mask_vector = building_outlines
         cat_col = "cat"
-    building_rast = f"building_rast_{os.getpid()}"
+    building_rast = f"building_rast_{pid}"
     rm_rasters.append(building_rast)
     grass.run_command(
         "v.to.rast",
@@ -390,6 +387,7 @@ def main():
             check_addon,
             create_grid,
             get_percentile,
+            insert_rows,
             set_nprocs,
             test_memory,
             verify_mapsets,
@@ -431,7 +429,7 @@ def main():
         r_mapcalc_cmd = "r.mapcalc"
 
     if grass.find_file(name="MASK", element="cell")["file"]:
-        tmp_mask_old = f"tmp_mask_old_{os.getpid()}"
+        tmp_mask_old = f"tmp_mask_old_{pid}"
         grass.run_command(
             "g.rename", raster=f"MASK,{tmp_mask_old}", quiet=True
         )
@@ -463,7 +461,7 @@ def main():
         )
 
     # Creating tiles
-    grid = f"grid_{os.getpid()}"
+    grid = f"grid_{pid}"
     rm_vectors.append(grid)
     tiles_list, number_tiles = create_grid(tile_size, grid, building_outlines)
     rm_vectors.extend(tiles_list)
@@ -478,12 +476,12 @@ def main():
     if segment_flag:
         # cut and transform nDSM
         grass.message(_("nDSM transformation..."))
-        ndsm_cut = f"ndsm_cut_{os.getpid()}"
+        ndsm_cut = f"ndsm_cut_{pid}"
         rm_rasters.append(ndsm_cut)
         # cut dtm extensively to also emphasize low buildings
         percentiles = [5, 50, 95]
         perc_values = get_percentile(ndsm, percentiles)
-        print(f"perc values are {perc_values}")
+        grass.debug(f"perc values are {perc_values}")
         med = perc_values[1]
         p_low = perc_values[0]
         p_high = perc_values[2]
@@ -601,25 +599,23 @@ def main():
         # it is faster to create a table, fill it, and join tables than using
         # v.db.update for each building cat
         veg_proportion_col = "veg_prop"
-        temp_table = f"buildings_table_{os.getpid()}"
+        temp_table = f"buildings_table_{pid}"
         rm_tables.append(temp_table)
         create_table_str = (
             f"CREATE TABLE {temp_table} (cat integer,"
             f" {veg_proportion_col} double precision)"
         )
         grass.run_command("db.execute", sql=create_table_str)
-        fill_table_str = (
-            f"INSERT INTO {temp_table} "
-            f"( cat, {veg_proportion_col} ) VALUES "
+        # the rows are passed to db.execute via stdin in several INSERT
+        # statements, as the SQL can be too long for many buildings
+        insert_rows(
+            temp_table,
+            ["cat", veg_proportion_col],
+            [
+                [str(dic["building_cat"]), str(round(dic["proportion"], 2))]
+                for dic in res_list
+            ],
         )
-        for dic in res_list:
-            fill_table_str += (
-                f"( {dic['building_cat']}, "
-                f"{round(dic['proportion'],2)} ), "
-            )
-        # remove final comma
-        fill_table_str = fill_table_str[:-2]
-        grass.run_command("db.execute", sql=fill_table_str)
         grass.run_command(
             "v.db.join",
             map=output_buildings,
@@ -72,11 +72,12 @@ rm_vectors = []
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmv in rm_vectors:
-        if grass.find_file(name=rmv, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
+    try:
+        from analyse_buildings_lib import remove_temporary_maps
+    except ImportError:
+        # library not found, so no temporary data has been created
+        return
+    remove_temporary_maps(rm_vectors=rm_vectors)
 
 
 def detect_changes(**kwargs):
@@ -169,13 +170,7 @@ def detect_changes(**kwargs):
         grass.run_command(
             "v.db.addcolumn",
             map=bu_input,
-            columns="a_cat INT",
-            quiet=True,
-        )
-        grass.run_command(
-            "v.db.addcolumn",
-            map=bu_input,
-            columns="b_cat INT",
+            columns="a_cat INT,b_cat INT",
             quiet=True,
         )
         grass.run_command(
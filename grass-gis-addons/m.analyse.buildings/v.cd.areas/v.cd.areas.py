@@ -90,6 +90,7 @@
 import atexit
 import os
 import re
+import subprocess
 import sys
 from uuid import uuid4
 
@@ -105,11 +106,22 @@ rm_dirs = []
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmv in rm_vectors:
-        if grass.find_file(name=rmv, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmv, **kwargs)
+    kwargs = {"flags": "f", "quiet": True, "stderr": subprocess.DEVNULL}
+    # check the vector directories directly instead of calling g.findfile
+    # for each map
+    env = grass.gisenv()
+    vdir = os.path.join(
+        env["GISDBASE"], env["LOCATION_NAME"], env["MAPSET"], "vector"
+    )
+    rm_vects = [
+        rmv
+        for rmv in dict.fromkeys(rm_vectors)
+        if os.path.isdir(os.path.join(vdir, rmv))
+    ]
+    if rm_vects:
+        grass.run_command(
+            "g.remove", type="vector", name=",".join(rm_vects), **kwargs
+        )
     for rmdir in rm_dirs:
         if os.path.isdir(rmdir):
             shutil.rmtree(rmdir)
@@ -135,6 +147,8 @@ def main():
 
     bu_input = options["input"]
     bu_ref = options["reference"]
+    bu_input_name = bu_input.split("@", 1)[0]
+    bu_ref_name = bu_ref.split("@", 1)[0]
     cd_output = options["output"]
     min_size = options["min_size"]
     max_fd = options["max_fd"]
@@ -238,15 +252,13 @@ def main():
         )
 
     # create list of tiles
-    tiles_list = list(
-        grass.parse_command(
-            "v.db.select",
-            map=grid_overlap,
-            columns="cat",
-            flags="c",
-            quiet=True,
-        ).keys()
-    )
+    tiles_list = grass.read_command(
+        "v.db.select",
+        map=grid_overlap,
+        columns="cat",
+        flags="c",
+        quiet=True,
+    ).splitlines()
 
     number_tiles = len(tiles_list)
     grass.message(_(f"Number of tiles is: {number_tiles}"))
@@ -378,21 +390,12 @@ def main():
             "v.db.addcolumn", map=change_merged, column="new_cat INTEGER"
         )
 
+        # b_cat takes precedence over a_cat, fill both in one update
         grass.run_command(
             "v.db.update",
             map=change_merged,
             column="new_cat",
-            where="a_cat IS NOT NULL",
-            query_column="a_cat",
-            quiet=True,
-        )
-
-        grass.run_command(
-            "v.db.update",
-            map=change_merged,
-            column="new_cat",
-            where="b_cat IS NOT NULL",
-            query_column="b_cat",
+            query_column="COALESCE(b_cat, a_cat)",
             quiet=True,
         )
 
@@ -416,6 +419,14 @@ def main():
     area_col = "area_sqm"
     fd_col = "fractal_d"
 
+    # create both columns with one call, v.to.db then only updates them;
+    # overwrite is needed as v.to.db refuses to write existing columns
+    grass.run_command(
+        "v.db.addcolumn",
+        map=change_diss,
+        columns=f"{area_col} DOUBLE PRECISION,{fd_col} DOUBLE PRECISION",
+        quiet=True,
+    )
     grass.run_command(
         "v.to.db",
         map=change_diss,
@@ -423,6 +434,7 @@ def main():
         columns=area_col,
         units="meters",
         quiet=True,
+        overwrite=True,
     )
 
     grass.run_command(
@@ -432,6 +444,7 @@ def main():
         columns=fd_col,
         units="meters",
         quiet=True,
+        overwrite=True,
     )
 
     grass.run_command(
@@ -449,20 +462,15 @@ def main():
         columns="source VARCHAR(100)",
         quiet=True,
     )
+    # a_cat takes precedence over b_cat, fill both in one update
     grass.run_command(
         "v.db.update",
         map=cd_output,
         column="source",
-        value=bu_input.split("@")[0],
-        where="b_cat IS NOT NULL",
-        quiet=True,
-    )
-    grass.run_command(
-        "v.db.update",
-        map=cd_output,
-        column="source",
-        value=bu_ref.split("@")[0],
-        where="a_cat IS NOT NULL",
+        query_column=(
+            f"CASE WHEN a_cat IS NOT NULL THEN '{bu_ref_name}' "
+            f"WHEN b_cat IS NOT NULL THEN '{bu_input_name}' END"
+        ),
         quiet=True,
     )
 
@@ -16,6 +16,7 @@
 #
 #############################################################################
 
+from functools import lru_cache
 import os
 import shutil
 
@@ -24,9 +25,11 @@ import multiprocessing as mp
 import psutil
 
 
+@lru_cache(maxsize=4)
 def freeRAM(unit, percent=100):
     """The function gives the amount of the percentages of the available
     RAM memory and free swap space.
+    The result is cached for the run of the calling module.
     Args:
         unit(string): 'GB' or 'MB'
         percent(int): number of percent which should be used of the available
@@ -54,8 +57,10 @@ def freeRAM(unit, percent=100):
         grass.fatal("Memory unit %s not supported" % unit)
 
 
+@lru_cache(maxsize=4)
 def get_free_ram(unit, percent=100):
     """The function gives the amount of the percentages of the installed RAM.
+    The result is cached for the run of the calling module.
     Args:
         unit(string): 'GB' or 'MB'
         percent(int): number of percent which should be used of the free RAM
@@ -100,66 +100,96 @@ from grass.pygrass.utils import get_lib_path
 
 
 # initialize global vars
-rm_rasters = []
 treetrunk_SQL_temp = None
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="cell")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
     if treetrunk_SQL_temp:
         grass.try_remove(treetrunk_SQL_temp)
 
 
-def treeheight(list_attr, treecrowns, ndsm):
-    # tree height:
-    # The tree height can be determined via the nDSM
-    # as the highest point of the crown area
-    grass.message(_("Calculating tree height..."))
-    col_height = "height"
-    col_height_perc = f"{col_height}_p95"
-    col_height_max = f"{col_height}_max"
-    if col_height_perc in list_attr:
-        grass.warning(
-            _(
-                f"Column {col_height_perc} is already included in vector map "
-                f"{treecrowns} and will be overwritten."
-            )
-        )
-        grass.run_command(
-            "v.db.dropcolumn",
-            map=treecrowns,
-            columns=col_height_perc,
-            quiet=True,
-        )
-    if col_height_max in list_attr:
+def drop_columns(list_attr, treecrowns, columns):
+    """Drop the given columns which are already included in the vector map
+    with one v.db.dropcolumn call, so that they can be calculated again
+    Args:
+        list_attr (frozenset): names of the attribute columns of treecrowns
+        treecrowns (str): name of the tree crowns vector map
+        columns (list): names of the columns which will be calculated
+    """
+    dropcolumns = [col for col in columns if col in list_attr]
+    for col in dropcolumns:
         grass.warning(
             _(
-                f"Column {col_height_max} is already included in vector map "
+                f"Column {col} is already included in vector map "
                 f"{treecrowns} and will be overwritten."
             )
         )
+    if dropcolumns:
         grass.run_command(
             "v.db.dropcolumn",
             map=treecrowns,
-            columns=col_height_max,
+            columns=",".join(dropcolumns),
             quiet=True,
         )
-    # Maximum and percentile (in case of outliers)
+
+
+def crown_stats(list_attr, treecrowns, ndsm, ndvi):
+    # Zonal statistics of nDSM and NDVI in one v.rast.stats run, so that the
+    # tree crowns are rasterized only once for both rasters
     grass.run_command(
         "v.rast.stats",
         map=treecrowns,
         type="area",
-        raster=ndsm,
-        column_prefix=col_height,
-        method="maximum,percentile",
+        raster=f"{ndsm},{ndvi}",
+        column_prefix="height,ndvi",
+        method="maximum,average,median,percentile",
         percentile=95,
         flags="c",
         quiet=True,
     )
+    # v.rast.stats calculates all methods for both rasters,
+    # remove the columns which are not needed
+    dropcolumns = [
+        col
+        for col in (
+            "height_average",
+            "height_median",
+            "ndvi_maximum",
+            "ndvi_percentile_95",
+        )
+        if col not in list_attr
+    ]
+    if dropcolumns:
+        grass.run_command(
+            "v.db.dropcolumn",
+            map=treecrowns,
+            columns=",".join(dropcolumns),
+            quiet=True,
+        )
+
+
+def treeheight(list_attr, treecrowns, ndsm, stats_calculated=False):
+    # tree height:
+    # The tree height can be determined via the nDSM
+    # as the highest point of the crown area
+    grass.message(_("Calculating tree height..."))
+    col_height = "height"
+    col_height_perc = f"{col_height}_p95"
+    col_height_max = f"{col_height}_max"
+    drop_columns(list_attr, treecrowns, [col_height_perc, col_height_max])
+    # Maximum and percentile (in case of outliers)
+    if not stats_calculated:
+        grass.run_command(
+            "v.rast.stats",
+            map=treecrowns,
+            type="area",
+            raster=ndsm,
+            column_prefix=col_height,
+            method="maximum,percentile",
+            percentile=95,
+            flags="c",
+            quiet=True,
+        )
     for rename in [
         f"{col_height}_maximum,{col_height_max}",
         f"{col_height}_percentile_95,{col_height_perc}",
@@ -188,9 +218,10 @@ def crownarea(list_attr, treecrowns):
         "v.to.db", map=treecrowns, option="area", columns=col_area, quiet=True
     )
     grass.message(_("Crown area was calculated."))
+    return col_area
 
 
-def crowndiameter(list_attr, treecrowns):
+def crowndiameter(list_attr, treecrowns, col_area=None):
     # Crown diameter:
     # Crown diameter can be determined in two ways:
     # once as the diameter of a circle,
@@ -211,25 +242,35 @@ def crowndiameter(list_attr, treecrowns):
         grass.run_command(
             "v.db.dropcolumn", map=treecrowns, columns=col_diameter, quiet=True
         )
-    grass.run_command(
-        "v.to.db",
-        map=treecrowns,
-        option="area",
-        columns=col_diameter,
-        quiet=True,
-    )
+    if col_area:
+        # use the already calculated crown area
+        grass.run_command(
+            "v.db.addcolumn",
+            map=treecrowns,
+            columns=f"{col_diameter} double precision",
+            quiet=True,
+        )
+    else:
+        grass.run_command(
+            "v.to.db",
+            map=treecrowns,
+            option="area",
+            columns=col_diameter,
+            quiet=True,
+        )
+        col_area = col_diameter
     # Assumption of a circle
     grass.run_command(
         "v.db.update",
         map=treecrowns,
         column=col_diameter,
-        query_column=f"2*(sqrt({col_diameter}/{math.pi}))",
+        query_column=f"2*(sqrt({col_area}/{math.pi}))",
     )
     grass.message(_("Crown diameter was calculated."))
     return col_diameter
 
 
-def ndvi_singletree(list_attr, treecrowns, ndvi):
+def ndvi_singletree(list_attr, treecrowns, ndvi, stats_calculated=False):
     # NDVI from color information per single tree:
     # For each pixel a NDVI value can be calculated from the aerial images.
     # The NDVI of a single tree results as mean or median value
@@ -238,42 +279,18 @@ def ndvi_singletree(list_attr, treecrowns, ndvi):
     col_ndvi = "ndvi"
     col_ndvi_ave = f"{col_ndvi}_av"
     col_ndvi_med = f"{col_ndvi}_med"
-    if col_ndvi_ave in list_attr:
-        grass.warning(
-            _(
-                f"Column {col_ndvi_ave} is already included in vector map "
-                f"{treecrowns} and will be overwritten."
-            )
-        )
-        grass.run_command(
-            "v.db.dropcolumn",
-            map=treecrowns,
-            columns=f"{col_ndvi_ave}",
-            quiet=True,
-        )
-    if col_ndvi_med in list_attr:
-        grass.warning(
-            _(
-                f"Column {col_ndvi_med} is already included in vector map "
-                f"{treecrowns} and will be overwritten."
-            )
-        )
+    drop_columns(list_attr, treecrowns, [col_ndvi_ave, col_ndvi_med])
+    if not stats_calculated:
         grass.run_command(
-            "v.db.dropcolumn",
+            "v.rast.stats",
             map=treecrowns,
-            columns=f"{col_ndvi_med}",
+            type="area",
+            raster=ndvi,
+            column_prefix=col_ndvi,
+            method="average,median",
             quiet=True,
+            flags="c",
         )
-    grass.run_command(
-        "v.rast.stats",
-        map=treecrowns,
-        type="area",
-        raster=ndvi,
-        column_prefix=col_ndvi,
-        method="average,median",
-        quiet=True,
-        flags="c",
-    )
     for attr_old, attr_new in zip(
         [f"{col_ndvi}_average", f"{col_ndvi}_median"],
         [col_ndvi_ave, col_ndvi_med],
@@ -293,7 +310,7 @@ def ndvi_singletree(list_attr, treecrowns, ndvi):
     grass.message(_("NDVI per single tree was calculated."))
 
 
-def crownvolume(list_attr, treecrowns, col_diameter):
+def crownvolume(list_attr, treecrowns, col_diameter=None, col_area=None):
     # Crown volume:
     # Accurate measurement of crown volume requires a true 3D model of the
     # tree crown. Alternatively, a sphere can be assumed as the crown shape
@@ -311,26 +328,46 @@ def crownvolume(list_attr, treecrowns, col_diameter):
                 f"map {treecrowns} and will be overwritten."
             )
         )
-    else:
+    if not col_diameter and not col_area:
+        # the diameter is not requested as output, so the volume is
+        # calculated from the crown area without an intermediate column
+        grass.run_command(
+            "v.to.db",
+            map=treecrowns,
+            option="area",
+            columns=col_volume,
+            quiet=True,
+            overwrite=True,
+        )
+        col_area = col_volume
+    elif col_volume not in list_attr:
         grass.run_command(
             "v.db.addcolumn",
             map=treecrowns,
             columns=f"{col_volume} double precision",
         )
     # Assumption: Circular volume
+    if col_diameter:
+        # (4/3 * pi * (d/2)^3 = pi/6 * d^3, the constant is computed in
+        # Python)
+        query_column = (
+            f"{math.pi / 6.}*{col_diameter}*{col_diameter}*{col_diameter}"
+        )
+    else:
+        # with d = 2 * sqrt(A/pi): 4/3 * pi * (d/2)^3 = 4/3 * A * sqrt(A/pi)
+        query_column = f"(4./3.)*{col_area}*sqrt({col_area}/{math.pi})"
     grass.run_command(
         "v.db.update",
         map=treecrowns,
         column=col_volume,
-        query_column=f"(4./3.)*{math.pi}*"
-        f"({col_diameter}/2.)*"
-        f"({col_diameter}/2.)*"
-        f"({col_diameter}/2.)",
+        query_column=query_column,
     )
     grass.message(_("Crown volume was calculated."))
 
 
 def treetrunk(list_attr, treecrowns):
+    global treetrunk_SQL_temp
+
     # Tree trunk position:
     # aerial photographs and normalized digital object models derived from them
     # cannot depict the trunk itself,
@@ -344,32 +381,9 @@ def treetrunk(list_attr, treecrowns):
     # Created with Vect_get_point_in_area which gets the point inside area and
     # outside all islands (from the largest IN segment the midpoint is taken).
     col_sp_cent = "pos_rand"
-    if f"{col_sp_cent}_x" in list_attr:
-        grass.warning(
-            _(
-                f"Column {col_sp_cent}_x is already included in vector map "
-                f"{treecrowns} and will be overwritten."
-            )
-        )
-        grass.run_command(
-            "v.db.dropcolumn",
-            map=treecrowns,
-            columns=f"{col_sp_cent}_x",
-            quiet=True,
-        )
-    if f"{col_sp_cent}_y" in list_attr:
-        grass.warning(
-            _(
-                f"Column {col_sp_cent}_y is already included in vector map "
-                f"{treecrowns} and will be overwritten."
-            )
-        )
-        grass.run_command(
-            "v.db.dropcolumn",
-            map=treecrowns,
-            columns=f"{col_sp_cent}_y",
-            quiet=True,
-        )
+    drop_columns(
+        list_attr, treecrowns, [f"{col_sp_cent}_x", f"{col_sp_cent}_y"]
+    )
     grass.run_command(
         "v.to.db",
         map=treecrowns,
@@ -380,15 +394,13 @@ def treetrunk(list_attr, treecrowns):
     )
     # Center of mass (calculated with surface triangulation)
     # as tree trunk position
-    v_centerpoints_mean = list(
-        grass.parse_command(
-            "v.centerpoint",
-            input=treecrowns,
-            type="area",
-            acenter="mean",
-            quiet=True,
-        ).keys()
-    )
+    v_centerpoints_mean = grass.read_command(
+        "v.centerpoint",
+        input=treecrowns,
+        type="area",
+        acenter="mean",
+        quiet=True,
+    ).splitlines()
     col_sp_mean = "pos_mass"
     if f"{col_sp_mean}_x" in list_attr:
         grass.warning(
@@ -407,18 +419,17 @@ def treetrunk(list_attr, treecrowns):
             ],
             quiet=True,
         )
-    # Create SQL file:
+    # Create SQL file (db.execute runs all statements in one transaction):
     treetrunk_SQL_temp = grass.tempfile()
+    sql_lines = []
+    for el in v_centerpoints_mean:
+        el_split = el.split("|")
+        sql_lines.append(
+            f"UPDATE {treecrowns} SET {col_sp_mean}_x={el_split[0]},"
+            f" {col_sp_mean}_y={el_split[1]} WHERE cat={el_split[-1]};\n"
+        )
     with open(treetrunk_SQL_temp, "w") as sql_file:
-        for el in v_centerpoints_mean:
-            el_cat = el.split("|")[-1]
-            el_x = el.split("|")[0]
-            el_y = el.split("|")[1]
-            sql_line = (
-                f"UPDATE {treecrowns} SET {col_sp_mean}_x={el_x},"
-                f" {col_sp_mean}_y={el_y} WHERE cat={el_cat};"
-            )
-            sql_file.write(f"{sql_line}\n")
+        sql_file.write("".join(sql_lines))
     grass.run_command("db.execute", input=treetrunk_SQL_temp, quiet=True)
     grass.message(_("Tree trunk position was calculated."))
 
@@ -472,58 +483,11 @@ def dist_to_building(list_attr, treecrowns, buildings, distance_building):
     grass.message(_("Distance to nearest building was calculated."))
 
 
-def dist_to_tree(
-    list_attr, treecrowns, treecrowns_complete, pid, distance_tree
-):
+def dist_to_tree(list_attr, treecrowns, treecrowns_complete, distance_tree):
     # Distance to nearest tree:
     # For given crown areas, the distance to the nearest other crown area
     # can be determined for each crown area.
     grass.message(_("Calculating distance to nearest tree..."))
-    # set region to tree-subset with buffer, to ensure
-    # all neighbouring trees (within buffer) are rasterized in the next step
-    grass.run_command(
-        "g.region",
-        vector=treecrowns,
-    )
-    # distance_tree given in meters,
-    # to be consistent with distance_building;
-    # must be converted to cells for g.regionn
-    nsres = grass.parse_command("g.region", flags="m")["nsres"]
-    distance_tree_cells = math.ceil(float(distance_tree) / float(nsres))
-    grass.run_command(
-        "g.region",
-        grow=distance_tree_cells,
-    )
-    treecrowns_rast = f"treecrowns_rast_{pid}"
-    rm_rasters.append(treecrowns_rast)
-    # use complete treecrown vector map (not only subset)
-    # to ensure using ALL neighbours
-    grass.run_command(
-        "v.to.rast",
-        input=treecrowns_complete,
-        output=treecrowns_rast,
-        use="cat",
-        quiet=True,
-    )
-    treecrowns_cat = [
-        int(val)
-        for val in list(
-            grass.parse_command(
-                "v.db.select", map=treecrowns, columns="cat", flags="c"
-            ).keys()
-        )
-    ]
-    treecrowns_complete_cat = [
-        int(val)
-        for val in list(
-            grass.parse_command(
-                "v.db.select",
-                map=treecrowns_complete,
-                columns="cat",
-                flags="c",
-            ).keys()
-        )
-    ]
     col_dist_trees = "dist_tree"
     if col_dist_trees in list_attr:
         grass.warning(
@@ -544,94 +508,60 @@ def dist_to_tree(
         columns=f"{col_dist_trees} double precision",
         quiet=True,
     )
-    grass.message(
-        _(f"Calculating distance for {len(treecrowns_cat)} trees...")
-    )
-    for cat in treecrowns_cat:
-        # create two maps for each cat-value:
-        # one with cat-value-polygon ONLY
-        # one with all BUT cat-value-polygon
-        # then calculate this with r.distance min distance
-        map_cat_only = f"map_cat_{cat}_only_{pid}"
-        rm_rasters.insert(
-            0, map_cat_only
-        )  # insert instead of append to rm_rasters, because they
-        # have to be deleted before base map treecrowns_rast in cleanup
-        rules_cat_only = f"{cat}={cat}"
-        grass.write_command(
-            "r.reclass",
-            input=treecrowns_rast,
-            output=map_cat_only,
-            rules="-",
-            stdin=rules_cat_only.encode(),
-            quiet=True,
-        )
-        # for distance to other trees, set region smaller
-        # with option: distance_tree
-        grass.run_command(
-            "g.region",
-            zoom=map_cat_only,
-        )
-        grass.run_command(
-            "g.region",
-            grow=distance_tree_cells,
-        )
-        map_all_but_cat = f"map_all_but_cat_{cat}_{pid}"
-        rm_rasters.insert(0, map_all_but_cat)
-        rules_all_but_cat = (
-            f"1 thru {max(treecrowns_complete_cat)} = "
-            f"{int(cat)+1}\n {cat} = NULL"
-        )
+    # use complete treecrown vector map (not only subset)
+    # to ensure using ALL neighbours;
+    # each tree crown has the distance 0 to itself, so only tree crowns with
+    # a distance larger than dmin are taken into account (distance_tree
+    # is given in meters, to be consistent with distance_building)
+    dmin = 0.0001
+    param = {
+        "from_": treecrowns,
+        "to": treecrowns_complete,
+        "upload": "dist",
+        "column": col_dist_trees,
+        "dmin": dmin,
+        "quiet": True,
+        "overwrite": True,
+    }
+    if distance_tree:
+        param["dmax"] = distance_tree
+    grass.run_command("v.distance", **param)
+    # adjacent tree crowns are excluded by dmin as well, so they are
+    # searched separately and get the distance 0
+    touching = grass.read_command(
+        "v.distance",
+        from_=treecrowns,
+        to=treecrowns_complete,
+        upload="cat",
+        dmax=dmin,
+        flags="pa",
+        separator="pipe",
+        quiet=True,
+    ).splitlines()[1:]
+    touching_cats = {
+        from_cat
+        for from_cat, to_cat in (line.split("|")[:2] for line in touching)
+        if from_cat != to_cat
+    }
+    if touching_cats:
+        # most crowns can touch others, so the cats are split into several
+        # UPDATE statements which are passed to db.execute via stdin, as
+        # they can exceed the maximum length of a command line argument
+        touching_cats = sorted(touching_cats, key=int)
+        batch_size = 500
+        sql_lines = [
+            f"UPDATE {treecrowns} SET {col_dist_trees}=0 WHERE cat IN "
+            f"({','.join(touching_cats[start : start + batch_size])});\n"
+            for start in range(0, len(touching_cats), batch_size)
+        ]
         grass.write_command(
-            "r.reclass",
-            input=treecrowns_rast,
-            output=map_all_but_cat,
-            rules="-",
-            stdin=rules_all_but_cat.encode(),
-            quiet=True,
-        )
-        try:
-            rdist_out = list(
-                grass.parse_command(
-                    "r.distance",
-                    map=f"{map_cat_only},{map_all_but_cat}",
-                    quiet=True,
-                ).keys()
-            )[0]
-            # Subtract resolution so that adjacent trees have distance 0;
-            # distance is then no longer from cell center to cell center
-            # (this is how distance is defined for r.distance),
-            # but from tree crown edge to tree crown edge
-            rdist_dist = float(rdist_out.split(":")[2]) - float(nsres)
-            if rdist_dist < 0:
-                rdist_dist = 0
-        except IndexError:
-            rdist_dist = "NULL"
-        # remove temporary maps already here, to avoid filling up the mapset
-        nuldev = open(os.devnull, "w")
-        kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-        for rmrast in [map_cat_only, map_all_but_cat]:
-            if grass.find_file(name=rmrast, element="cell")["file"]:
-                grass.run_command(
-                    "g.remove", type="raster", name=rmrast, **kwargs
-                )
-        # Set region back, for next iteration
-        grass.run_command("g.region", vector=treecrowns)
-        grass.run_command(
-            "v.db.update",
-            map=treecrowns,
-            column=col_dist_trees,
-            where=f"cat == {cat}",
-            value=rdist_dist,
-            quiet=True,
+            "db.execute", input="-", stdin="".join(sql_lines), quiet=True
         )
     grass.message(_("Distance to nearest tree was calculated."))
 
 
 def main():
-    global rm_rasters, treetrunk_SQL_temp
-
-    pid = os.getpid()
+    global treetrunk_SQL_temp
 
     treecrowns = options["treecrowns"]
     treecrowns_complete = options["treecrowns_complete"]
@@ -696,36 +626,37 @@ def main():
     grass.run_command("g.region", vector=treecrowns, flags="ap")
 
     # List of attribute columns of single tree vector map
-    list_attr = [
+    list_attr = frozenset(
         el.split("|")[1]
-        for el in list(
-            grass.parse_command("v.info", map=treecrowns, flags="c").keys()
-        )
-    ]
+        for el in grass.read_command(
+            "v.info", map=treecrowns, flags="c"
+        ).splitlines()
+    )
 
     # Calculate various tree parameters
-    if not treeparamset or "height" in treeparamset:
-        treeheight(list_attr, treecrowns, ndsm)
+    calc_height = not treeparamset or "height" in treeparamset
+    calc_ndvi = not treeparamset or "ndvi" in treeparamset
+    stats_calculated = calc_height and calc_ndvi
+    if stats_calculated:
+        crown_stats(list_attr, treecrowns, ndsm, ndvi)
+    if calc_height:
+        treeheight(list_attr, treecrowns, ndsm, stats_calculated)
+    col_area = None
     if not treeparamset or "area" in treeparamset:
-        crownarea(list_attr, treecrowns)
-    if (
-        not treeparamset
-        or "diameter" in treeparamset
-        or "volume" in treeparamset
-    ):
-        col_diameter = crowndiameter(list_attr, treecrowns)
-    if not treeparamset or "ndvi" in treeparamset:
-        ndvi_singletree(list_attr, treecrowns, ndvi)
+        col_area = crownarea(list_attr, treecrowns)
+    col_diameter = None
+    if not treeparamset or "diameter" in treeparamset:
+        col_diameter = crowndiameter(list_attr, treecrowns, col_area)
+    if calc_ndvi:
+        ndvi_singletree(list_attr, treecrowns, ndvi, stats_calculated)
     if not treeparamset or "volume" in treeparamset:
-        crownvolume(list_attr, treecrowns, col_diameter)
+        crownvolume(list_attr, treecrowns, col_diameter, col_area)
     if not treeparamset or "position" in treeparamset:
         treetrunk(list_attr, treecrowns)
     if not treeparamset or "dist_building" in treeparamset:
         dist_to_building(list_attr, treecrowns, buildings, distance_building)
     if not treeparamset or "dist_tree" in treeparamset:
-        dist_to_tree(
-            list_attr, treecrowns, treecrowns_complete, pid, distance_tree
-        )
+        dist_to_tree(list_attr, treecrowns, treecrowns_complete, distance_tree)
 
     # set GISRC to original gisrc and delete newgisrc
     os.environ["GISRC"] = gisrc
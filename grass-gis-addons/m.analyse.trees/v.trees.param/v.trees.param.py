@@ -98,6 +98,7 @@
 import os
 import sys
 import atexit
+import subprocess
 import multiprocessing as mp
 import math
 
@@ -116,11 +117,17 @@ rm_files = []
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmvect in subset_names:
-        if grass.find_file(name=rmvect, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmvect, **kwargs)
+    if subset_names:
+        # g.remove -f ignores not existing maps, so no existence check is
+        # needed before removing all subsets at once
+        grass.run_command(
+            "g.remove",
+            type="vector",
+            name=",".join(subset_names),
+            flags="f",
+            quiet=True,
+            stderr=subprocess.DEVNULL,
+        )
     # Delete temp_mapsets
     for num, new_mapset in zip(range(nprocs), mapset_names):
         grass.utils.try_rmdir(os.path.join(location_path, new_mapset))
@@ -200,11 +207,9 @@ def main():
     # save current mapset
     start_cur_mapset = grass.gisenv()["MAPSET"]
 
-    treecrowns_cat = list(
-        grass.parse_command(
-            "v.db.select", map=treecrowns, columns="cat", flags="c"
-        ).keys()
-    )
+    treecrowns_cat = grass.read_command(
+        "v.db.select", map=treecrowns, columns="cat", flags="c"
+    ).splitlines()
     size_subset = math.ceil(len(treecrowns_cat) / nprocs)
 
     queue = ParallelModuleQueue(nprocs=nprocs)
@@ -229,8 +234,7 @@ def main():
             cats_val_file = grass.tempname(12)
             rm_files.append(cats_val_file)
             with open(cats_val_file, "w") as cats_file:
-                for val in cats_val:
-                    cats_file.write(f"{val}\n")
+                cats_file.write("\n".join(cats_val))
             subset_ind += size_subset
             grass.run_command(
                 "v.extract",
@@ -208,6 +208,7 @@
 # %end
 
 import atexit
+from functools import lru_cache
 import os
 import psutil
 import grass.script as grass
@@ -406,8 +407,10 @@ def cleanup():
             grass.utils.try_rmdir(os.path.join(location_path, new_mapset))
 
 
+@lru_cache(maxsize=4)
 def freeRAM(unit, percent=100):
     """The function gives the amount of the percentages of the installed RAM.
+    The result is cached for the run of the module.
     Args:
         unit(string): 'GB' or 'MB'
         percent(int): number of percent which should be used of the free RAM
@@ -781,17 +784,25 @@ def import_laz(data, output_name, resolutions, study_area=None):
                 nprocs_laz = len(laz_list)
             queue = ParallelModuleQueue(nprocs=nprocs_laz)
             try:
-                for laz_file in laz_list:
-                    name = (
-                        f"{output_name}_{os.path.basename(laz_file).split('.')[0]}"
-                        f"_{get_res_str(res)}"
+                # each worker imports a batch of LAZ files in its own mapset,
+                # so that a mapset is created only once per batch
+                for num in range(nprocs_laz):
+                    laz_batch = laz_list[num::nprocs_laz]
+                    new_mapset = (
+                        f"tmp_mapset_{output_name}_{get_res_str(res)}_{num}"
                     )
-                    new_mapset = f"tmp_mapset_{name}"
                     rm_mapsets.append(new_mapset)
-                    raster_list.append(name)
-                    laz_outs.append(f"{name}@{new_mapset}")
-                    r_in_pdal_kwargs["input"] = laz_file
-                    r_in_pdal_kwargs["output"] = name
+                    names = []
+                    for laz_file in laz_batch:
+                        name = (
+                            f"{output_name}_{os.path.basename(laz_file).split('.')[0]}"
+                            f"_{get_res_str(res)}"
+                        )
+                        names.append(name)
+                        raster_list.append(name)
+                        laz_outs.append(f"{name}@{new_mapset}")
+                    r_in_pdal_kwargs["input"] = ",".join(laz_batch)
+                    r_in_pdal_kwargs["output"] = ",".join(names)
                     # generate 95%-max DSM
                     r_in_pdal = Module(
                         "r.in.pdal.worker",
@@ -1151,8 +1162,8 @@ def import_xyz(data, src_res, dest_res, output_name):
         separator="space",
     )
     xyz_reg = {
-        item.split("=")[0]: float(item.split("=")[1])
-        for item in xyz_reg_str.strip().split(" ")
+        key: float(value)
+        for key, value in (item.split("=", 1) for item in xyz_reg_str.split())
     }
     dtm_res_h = src_res / 2.0
     north = xyz_reg["n"] + dtm_res_h
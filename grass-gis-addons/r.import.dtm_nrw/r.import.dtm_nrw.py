@@ -29,12 +29,17 @@
 # % key: directory
 # % required: no
 # % multiple: no
-# % label: Directory path where to download and temporarily store the digital terrain model (DTM) data. If not set, the data will be downloaded to a temporary directory. The downloaded data will be removed after the import.
+# % label: Directory path where to download and temporarily store the digital terrain model (DTM) data. If not set, the data will be downloaded to a temporary directory. The downloaded data will be removed after the import. Tiles which already exist in the directory are imported without downloading them again and are kept.
 # %end
 
 # %option G_OPT_MEMORYMB
 # %end
 
+# %option G_OPT_M_NPROCS
+# % label: Number of cores for the parallel import of the tiles, -2 is the number of available cores - 1
+# % answer: -2
+# %end
+
 # %option G_OPT_R_OUTPUT
 # % key: output
 # % type: string
@@ -45,16 +50,27 @@
 # %end
 
 import atexit
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from functools import lru_cache
 import psutil
 import os
-from pyproj import Transformer
-import gzip
 from itertools import product
+import multiprocessing as mp
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import shutil
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 import grass.script as grass
 
+# use the faster ISA-L implementation for the decompression of the tiles if
+# it is installed
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
 # initialize global vars
 TMPLOC = None
 SRCGISRC = None
@@ -68,6 +84,26 @@ rm_folders = []
 
 dtm_res = 1
 
+# number of parallel requests to the download server
+num_requests = 16
+# number of parallel downloads (limited to not exceed the rate limits of the
+# download server)
+num_downloads = 8
+# one session for all requests to reuse the connections to the server
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=num_requests,
+        pool_maxsize=num_requests,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    ),
+)
+
 
 def cleanup():
     nuldev = open(os.devnull, "w")
@@ -101,8 +137,10 @@ def cleanup():
                 grass.warning(_("Cannot remove dir <%s>: %s" % (folder, e)))
 
 
+@lru_cache(maxsize=4)
 def freeRAM(unit, percent=100):
     """The function gives the amount of the percentages of the installed RAM.
+    The result is cached for the run of the module.
     Args:
         unit(string): 'GB' or 'MB'
         percent(int): number of percent which should be used of the free RAM
@@ -140,12 +178,73 @@ def test_memory():
         grass.warning("Set used memory to %d MB." % (options["memory"]))
 
 
-def transform_coord(x, y, from_epsg, to_epsg):
-    transformer = Transformer.from_crs(
+@lru_cache(maxsize=32)
+def get_transformer(from_epsg, to_epsg):
+    """Create the transformer between two EPSG codes only once, as its
+    creation is much more expensive than the transformation itself
+    """
+    # pyproj is only imported if the location is not in EPSG:25832
+    from pyproj import Transformer
+
+    return Transformer.from_crs(
         "epsg:%s" % from_epsg, "epsg:%s" % to_epsg, always_xy=True
     )
-    transformed = transformer.transform(x, y)
-    return (transformed[0], transformed[1])
+
+
+def set_nprocs(nprocs):
+    if nprocs == -2:
+        nprocs = mp.cpu_count() - 1 if mp.cpu_count() > 1 else 1
+    elif nprocs in (-1, 0):
+        grass.warning(
+            _(
+                "Number of cores for multiprocessing must be 1 or "
+                "higher. Option <nprocs> will be set to 1 (serial "
+                "processing)."
+            )
+        )
+        nprocs = 1
+    elif nprocs > mp.cpu_count():
+        grass.warning(
+            _(
+                f"Using {nprocs} parallel processes but only "
+                f"{mp.cpu_count()} CPUs available."
+            )
+        )
+        nprocs = mp.cpu_count()
+    return nprocs
+
+
+def transform_coords(xs, ys, from_epsg, to_epsg):
+    """Transform several coordinates with one call of the transformer
+    Args:
+        xs (list): x coordinates
+        ys (list): y coordinates
+        from_epsg (str): EPSG code of the coordinates
+        to_epsg (str): EPSG code to transform the coordinates to
+    Returns:
+        (list): Tuples of the transformed x and y coordinates
+    """
+    transformer = get_transformer(from_epsg, to_epsg)
+    transformed = transformer.transform(xs, ys)
+    return list(zip(transformed[0], transformed[1]))
+
+
+@lru_cache(maxsize=1)
+def get_location_proj():
+    """Get the projection information of the current location, which is
+    only queried once as it does not change before the switch to the
+    temporary location
+    """
+    return grass.parse_command("g.proj", flags="g")
+
+
+def get_location_epsg():
+    """Get the EPSG code of the current location"""
+    proj = get_location_proj()
+    if "epsg" in proj:
+        return proj["epsg"]
+    else:
+        return proj["srid"].split("EPSG:")[1]
 
 
 def get_required_tiles():
@@ -157,11 +256,7 @@ def get_required_tiles():
     west_raw = region_dict["w"]
     east_raw = region_dict["e"]
     # get projection of current location
-    proj = grass.parse_command("g.proj", flags="g")
-    if "epsg" in proj:
-        epsg = proj["epsg"]
-    else:
-        epsg = proj["srid"].split("EPSG:")[1]
+    epsg = get_location_epsg()
     if epsg == "25832":
         north = north_raw
         south = south_raw
@@ -170,23 +265,139 @@ def get_required_tiles():
         lowerleft = (float(west), float(south))
         upperright = (float(east), float(north))
     else:
-        lowerleft = transform_coord(west_raw, south_raw, epsg, "25832")
-        upperright = transform_coord(east_raw, north_raw, epsg, "25832")
+        lowerleft, upperright = transform_coords(
+            [float(west_raw), float(east_raw)],
+            [float(south_raw), float(north_raw)],
+            epsg,
+            "25832",
+        )
 
-    required_ns_tiles = list(
-        range(int(lowerleft[1] / 1000), int(upperright[1] / 1000) + 1, 1)
+    required_ns_tiles = range(
+        int(lowerleft[1] / 1000), int(upperright[1] / 1000) + 1
     )
-    required_ew_tiles = list(
-        range(int(lowerleft[0] / 1000), int(upperright[0] / 1000) + 1, 1)
+    required_ew_tiles = range(
+        int(lowerleft[0] / 1000), int(upperright[0] / 1000) + 1
     )
-    required_tiles_raw = list(product(required_ew_tiles, required_ns_tiles))
-    required_tiles = []
-    for tile in required_tiles_raw:
-        tilename = "dgm1_32_{}_{}_1_nw.xyz.gz".format(tile[0], tile[1])
-        required_tiles.append(tilename)
+    required_tiles = [
+        f"dgm1_32_{ew_tile}_{ns_tile}_1_nw.xyz.gz"
+        for ew_tile, ns_tile in product(required_ew_tiles, required_ns_tiles)
+    ]
     return required_tiles
 
 
+def get_available_tiles(required_tiles, baseurl):
+    """Check in parallel which of the required tiles are available on the
+    download server
+    Args:
+        required_tiles (list): Names of the required tiles
+        baseurl (str): URL of the download directory (ending with "/")
+    Returns:
+        dl_urls (list): Tuples of tile name and URL of the available tiles
+    """
+
+    def check_url(url):
+        return SESSION.head(url, allow_redirects=True, timeout=30)
+
+    urls = [f"{baseurl}{tile}" for tile in required_tiles]
+    with ThreadPoolExecutor(max_workers=num_requests) as executor:
+        responses = list(tqdm(executor.map(check_url, urls), total=len(urls)))
+    dl_urls = []
+    for tile, url, response in zip(required_tiles, urls, responses):
+        if response.status_code != 200:
+            grass.warning(
+                _(
+                    "Tile {} is not available. The region is"
+                    " probably partially outside of NRW."
+                ).format(tile)
+            )
+        else:
+            dl_urls.append((tile, url))
+    return dl_urls
+
+
+def download_tile(dl_url, dl_target):
+    """Download a tile in chunks to a partial file, which is renamed to the
+    target file once the download is complete, so that an interrupted
+    download is not reused as a tile later
+    Args:
+        dl_url (str): URL of the tile
+        dl_target (str): Path of the downloaded file
+    Returns:
+        dl_target (str): Path of the downloaded file
+    """
+    part_target = f"{dl_target}.part"
+    try:
+        with SESSION.get(dl_url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            with open(part_target, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024**2):
+                    f.write(chunk)
+        os.replace(part_target, dl_target)
+    except Exception as e:
+        if os.path.isfile(part_target):
+            os.remove(part_target)
+        grass.fatal(
+            _("There was a problem downloading {}: {}").format(dl_url, e)
+        )
+    return dl_target
+
+
+def import_tile(path):
+    """Import a downloaded XYZ tile as raster map
+    Args:
+        path (str): Path of the downloaded tile
+    Returns:
+        basename (str): Name of the imported raster map
+    """
+    basename_tmp = os.path.basename(path)
+    basename = os.path.splitext(basename_tmp)[0].split(".xyz")[0]
+    rm_rasters.append(basename)
+    # decompress the tile in chunks to a file, which r.in.xyz can read
+    # directly, instead of holding the whole content in memory
+    xyz_path = os.path.splitext(path)[0]
+    rm_files.append(xyz_path)
+    with gzip.open(path, "rb") as file, open(xyz_path, "wb") as xyz_file:
+        shutil.copyfileobj(file, xyz_file, length=1024**2)
+    # get the extent of the points directly from the data, so that the data
+    # only has to be read by r.in.xyz once for the import
+    coords = np.loadtxt(xyz_path, usecols=(0, 1))
+    west, south = coords.min(axis=0)
+    east, north = coords.max(axis=0)
+    dtm_res_h = dtm_res / 2.0
+    north += dtm_res_h
+    south -= dtm_res_h
+    west -= dtm_res_h
+    east += dtm_res_h
+    # the region is only set for the import process, so that several tiles
+    # can be imported in parallel
+    import_env = os.environ.copy()
+    import_env["GRASS_REGION"] = grass.region_env(
+        n=north, s=south, w=west, e=east, res=dtm_res
+    )
+    grass.run_command(
+        "r.in.xyz",
+        output=basename,
+        input=xyz_path,
+        method="mean",
+        separator="space",
+        quiet=True,
+        env=import_env,
+    )
+    # the decompressed tile is not needed anymore
+    os.remove(xyz_path)
+    rm_files.remove(xyz_path)
+    grass.run_command(
+        "r.region",
+        map=basename,
+        n=north + dtm_res_h,
+        s=south + dtm_res_h,
+        w=west + dtm_res_h,
+        e=east + dtm_res_h,
+        quiet=True,
+    )
+    return basename
+
+
 def createTMPlocation(epsg=4326):
     global TMPLOC, SRCGISRC
     SRCGISRC = grass.tempfile()
@@ -198,8 +409,7 @@ def createTMPlocation(epsg=4326):
     f.write("GUI: text\n")
     f.close()
 
-    proj_test = grass.parse_command("g.proj", flags="g")
-    if "epsg" in proj_test:
+    if "epsg" in get_location_proj():
         epsg_arg = {"epsg": epsg}
     else:
         epsg_arg = {"srid": "EPSG:{}".format(epsg)}
@@ -233,6 +443,7 @@ def get_actual_location():
 
 def main():
     global rm_rasters, rm_vectors, old_region, rm_folders, rm_files
+    nprocs = set_nprocs(int(options["nprocs"]))
     # save old region
     old_region = "saved_region_{}".format(os.getpid())
     grass.run_command("g.region", save=old_region)
@@ -248,35 +459,27 @@ def main():
         "https://www.opengeodata.nrw.de/produkte/geobasis/hm/"
         "dgm1_xyz/dgm1_xyz/"
     )
+    # reuse tiles which are already stored in the download directory
+    existing_paths = []
+    missing_tiles = []
+    for tile in required_tiles:
+        path = os.path.join(download_dir, tile)
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            existing_paths.append(path)
+        else:
+            missing_tiles.append(tile)
+    if existing_paths:
+        grass.message(
+            _("Using {} tiles from <{}>...").format(
+                len(existing_paths), download_dir
+            )
+        )
     # check if tiles exist
     dl_urls = []
-    local_paths = []
-    grass.message(_("Verifying URLS and Downloading Tiles..."))
-    for tile in tqdm(required_tiles):
-        dl_url = os.path.join(baseurl, tile)
-        response = requests.get(dl_url)
-        if response.status_code != 200:
-            grass.warning(
-                _(
-                    "Tile {} is not available. The region is"
-                    " probably partially outside of NRW."
-                ).format(tile)
-            )
-        else:
-            dl_urls.append((tile, dl_url))
-            dl_target = os.path.join(download_dir, tile)
-            rm_files.append(dl_target)
-            try:
-                with open(dl_target, "wb") as f:
-                    f.write(response.content)
-                local_paths.append((tile, dl_target))
-            except Exception as e:
-                grass.fatal(
-                    _("There was a problem downloading {}: {}").format(
-                        dl_url, e
-                    )
-                )
-    if len(dl_urls) == 0:
+    if missing_tiles:
+        grass.message(_("Verifying URLS..."))
+        dl_urls = get_available_tiles(missing_tiles, baseurl)
+    if len(dl_urls) + len(existing_paths) == 0:
         grass.fatal(_("No valid tiles found."))
     # create temp import location if the current location is not 25832
     # save current region as vector
@@ -284,11 +487,7 @@ def main():
     rm_vectors.append(region_vect)
     grass.run_command("v.in.region", output=region_vect, quiet=True)
     # get projection of current location
-    proj = grass.parse_command("g.proj", flags="g")
-    if "epsg" in proj:
-        epsg = proj["epsg"]
-    else:
-        epsg = proj["srid"].split("EPSG:")[1]
+    epsg = get_location_epsg()
     reproject = False
     if epsg != "25832":
         reproject = True
@@ -304,81 +503,45 @@ def main():
             quiet=True,
         )
 
+    # import the tiles as soon as they are downloaded, so that the download
+    # of the remaining tiles and the import overlap
     raster_maps = []
-    grass.message(_("\nImporting data..."))
-    for path_tuple in local_paths:
-        path = path_tuple[1]
-        basename_tmp = os.path.basename(path)
-        basename = os.path.splitext(basename_tmp)[0].split(".xyz")[0]
-        raster_maps.append(basename)
-        rm_rasters.append(basename)
-        with gzip.open(path, "rb") as file:
-            file_content = file.read()
-        region_proc = grass.start_command(
-            "r.in.xyz",
-            output="dummy",
-            input="-",
-            flags="sg",
-            separator="space",
-            stdin=grass.PIPE,
-            stdout=grass.PIPE,
-        )
-        region_proc.stdin.write(file_content)
-        stdout = region_proc.communicate()[0].decode("ascii")
-        region_proc.stdin.close()
-        region_proc.wait()
-        arglist = stdout.split(" ")
-        dtm_res_h = dtm_res / 2.0
-        north = (
-            float(
-                [item for item in arglist if "n=" in item][0].replace("n=", "")
-            )
-            + dtm_res_h
-        )
-        south = (
-            float(
-                [item for item in arglist if "s=" in item][0].replace("s=", "")
-            )
-            - dtm_res_h
-        )
-        west = (
-            float(
-                [item for item in arglist if "w=" in item][0].replace("w=", "")
-            )
-            - dtm_res_h
-        )
-        east = (
-            float(
-                [item for item in arglist if "e=" in item][0].replace("e=", "")
+    grass.message(_("Downloading and importing tiles..."))
+    with ThreadPoolExecutor(
+        max_workers=num_downloads
+    ) as dl_executor, ThreadPoolExecutor(max_workers=nprocs) as executor:
+        dl_futures = []
+        for tile, dl_url in dl_urls:
+            dl_target = os.path.join(download_dir, tile)
+            # keep the tiles in a directory given by the user for reuse
+            if not options["directory"]:
+                rm_files.append(dl_target)
+            dl_futures.append(
+                dl_executor.submit(download_tile, dl_url, dl_target)
             )
-            + dtm_res_h
+        import_futures = [
+            executor.submit(import_tile, path) for path in existing_paths
+        ]
+        import_futures.extend(
+            executor.submit(import_tile, future.result())
+            for future in as_completed(dl_futures)
         )
+        for future in tqdm(
+            as_completed(import_futures), total=len(import_futures)
+        ):
+            raster_maps.append(future.result())
+    grass.message(_("Patching tiles together..."))
+    grass.run_command("g.region", vector=region_vect, res=1, quiet=True)
+    if len(raster_maps) > 1 and reproject is True:
+        # the tiles are only read once more by r.proj, so a virtual mosaic is
+        # sufficient in the temporary location
         grass.run_command(
-            "g.region", n=north, s=south, w=west, e=east, res=dtm_res
-        )
-        import_proc = grass.feed_command(
-            "r.in.xyz",
-            output=basename,
-            input="-",
-            method="mean",
-            separator="space",
+            "r.buildvrt",
+            input=",".join(raster_maps),
+            output=options["output"],
             quiet=True,
         )
-        import_proc.stdin.write(file_content)
-        import_proc.stdin.close()
-        import_proc.wait()
-        grass.run_command(
-            "g.region",
-            n=f"n+{dtm_res_h}",
-            s=f"s+{dtm_res_h}",
-            w=f"w+{dtm_res_h}",
-            e=f"e+{dtm_res_h}",
-            res=dtm_res,
-        )
-        grass.run_command("r.region", map=basename, flags="c")
-    grass.message(_("Patching tiles together..."))
-    grass.run_command("g.region", vector=region_vect, res=1, quiet=True)
-    if len(raster_maps) > 1:
+    elif len(raster_maps) > 1:
         grass.run_command(
             "r.patch", input=",".join(raster_maps), output=options["output"]
         )
@@ -72,6 +72,7 @@
 # %end
 
 import atexit
+from functools import lru_cache
 import psutil
 import os
 import grass.script as grass
@@ -92,8 +93,10 @@ def cleanup():
         grass.run_command("g.remove", type="region", name=old_region, **kwargs)
 
 
+@lru_cache(maxsize=4)
 def freeRAM(unit, percent=100):
     """The function gives the amount of the percentages of the installed RAM.
+    The result is cached for the run of the module.
     Args:
         unit(string): 'GB' or 'MB'
         percent(int): number of percent which should be used of the free RAM
@@ -131,6 +134,27 @@ def test_memory():
         grass.warning("Set used memory to %d MB." % (options["memory"]))
 
 
+def is_aligned(raster_region, region):
+    """Check if a raster map or region has the same resolution as the given
+    region and if their grids are aligned
+    Args:
+        raster_region (dict): Region or raster info with n, w, nsres, ewres
+        region (dict): Region with n, w, nsres, ewres
+    Returns:
+        (bool): True if the resolution and the grid alignment are the same
+    """
+    for res_key, bound_key in (("nsres", "n"), ("ewres", "w")):
+        res = float(region[res_key])
+        if abs(float(raster_region[res_key]) - res) > res * 1e-6:
+            return False
+        offset = (
+            float(raster_region[bound_key]) - float(region[bound_key])
+        ) / res
+        if abs(offset - round(offset)) > 1e-6:
+            return False
+    return True
+
+
 def main():
     global rm_rasters, old_region
     dsm = options["dsm"]
@@ -182,42 +206,78 @@ def main():
     else:
         dtm_resampled = "tmp_dtm_1_resampled_{}".format(os.getpid())
         rm_rasters.append(dtm_resampled)
-    grass.run_command(
-        "r.resamp.interp",
-        input=tmp_dtm_1,
-        output=dtm_resampled,
-        method="bilinear",
-        quiet=True,
-    )
+    dtm_info = grass.raster_info(tmp_dtm_1)
+    dtm_region = {
+        "n": dtm_info["north"],
+        "w": dtm_info["west"],
+        "nsres": dtm_info["nsres"],
+        "ewres": dtm_info["ewres"],
+    }
+    if not is_aligned(dtm_region, grass.region()):
+        grass.run_command(
+            "r.resamp.interp",
+            input=tmp_dtm_1,
+            output=dtm_resampled,
+            method="bilinear",
+            quiet=True,
+        )
+    elif options["output_dtm"]:
+        # the DTM already has the grid of the DSM, so it is only cut to the
+        # region of the DSM
+        grass.run_command(
+            "r.mapcalc",
+            expression=f"{dtm_resampled} = {tmp_dtm_1}",
+            quiet=True,
+        )
+    else:
+        # the DTM already has the grid of the DSM and can be used directly
+        dtm_resampled = tmp_dtm_1
     # calculate first version of ndsm
     grass.message(_("nDSM creation..."))
-    ndsm_raw = "ndsm_raw_{}".format(os.getpid())
-    rm_rasters.append(ndsm_raw)
-    grass.run_command(
-        "r.mapcalc",
-        expression="{} = float({} - {})".format(
-            ndsm_raw, dsm_nullsfilled, dtm_resampled
-        ),
-        quiet=True,
-    )
-    # resample ndsm to match original region
-    grass.run_command("g.region", region=old_region, quiet=True)
-    ndsm_resampled_tmp = "ndsm_resampled_tmp_{}".format(os.getpid())
-    rm_rasters.append(ndsm_resampled_tmp)
-    grass.run_command(
-        "r.resamp.interp",
-        input=ndsm_raw,
-        output=ndsm_resampled_tmp,
-        method="bilinear",
-        quiet=True,
-    )
-    grass.run_command(
-        "r.mapcalc",
-        expression="{} = float({})".format(
-            options["output_ndsm"], ndsm_resampled_tmp
-        ),
-        quiet=True,
+    output_region = grass.parse_command(
+        "g.region", region=old_region, flags="gu"
     )
+    if is_aligned(grass.region(), output_region):
+        # the grid of the DSM matches the original region, so the nDSM can be
+        # calculated directly in the original region without resampling
+        grass.run_command("g.region", region=old_region, quiet=True)
+        grass.run_command(
+            "r.mapcalc",
+            expression="{} = float({} - {})".format(
+                options["output_ndsm"], dsm_nullsfilled, dtm_resampled
+            ),
+            quiet=True,
+        )
+    else:
+        ndsm_raw = "ndsm_raw_{}".format(os.getpid())
+        rm_rasters.append(ndsm_raw)
+        grass.run_command(
+            "r.mapcalc",
+            expression="{} = float({} - {})".format(
+                ndsm_raw, dsm_nullsfilled, dtm_resampled
+            ),
+            quiet=True,
+        )
+        # resample ndsm to match original region
+        grass.run_command("g.region", region=old_region, quiet=True)
+        ndsm_resampled_tmp = "ndsm_resampled_tmp_{}".format(os.getpid())
+        rm_rasters.append(ndsm_resampled_tmp)
+        grass.run_command(
+            "r.resamp.interp",
+            input=ndsm_raw,
+            output=ndsm_resampled_tmp,
+            method="bilinear",
+            quiet=True,
+        )
+        # r.resamp.interp writes double precision, so the final nDSM is
+        # converted to float
+        grass.run_command(
+            "r.mapcalc",
+            expression="{} = float({})".format(
+                options["output_ndsm"], ndsm_resampled_tmp
+            ),
+            quiet=True,
+        )
     grass.message(
         _("Created nDSM raster map <{}>").format(options["output_ndsm"])
     )
@@ -44,14 +44,19 @@
 # % description: Resolution which is set with g.region before r.in.pdal
 # %end
 
+# %option G_OPT_M_NPROCS
+# % label: Number of r.in.pdal processes to run in parallel for several input files
+# % answer: 1
+# %end
+
 # %option
 # % key: input
 # % type: string
 # % required: no
-# % multiple: no
+# % multiple: yes
 # % key_desc: name
-# % label: LAS input file
-# % description: LiDAR input files in LAS format (*.las or *.laz)
+# % label: LAS input file(s)
+# % description: LiDAR input files in LAS format (*.las or *.laz); several files are imported one after the other in the same mapset
 # % gisprompt: old,bin,file
 # % guisection: Input
 # %end
@@ -60,9 +65,9 @@
 # % key: output
 # % type: string
 # % required: no
-# % multiple: no
+# % multiple: yes
 # % key_desc: name
-# % description: Name for output raster map
+# % description: Name for output raster map(s), one for each input file
 # % gisprompt: new,cell,raster
 # % guisection: Output
 # %end
@@ -305,37 +310,13 @@
 # %end
 
 
-import atexit
+import math
 import os
 import shutil
 
 import grass.script as grass
 
 
-# initialize global vars
-orig_region = None
-
-
-def reset_region(region):
-    """Function to set the region to the given region
-    Args:
-        region (str): the name of the saved region which should be set and
-                      deleted
-    """
-    nulldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nulldev}
-    if region:
-        if grass.find_file(name=region, element="windows")["file"]:
-            grass.run_command("g.region", region=region)
-            grass.run_command("g.remove", type="region", name=region, **kwargs)
-
-
-def cleanup():
-    """Cleanup function"""
-    grass.message(_("Cleaning up ..."))
-    reset_region(orig_region)
-
-
 def switch_to_new_mapset(new_mapset):
     """The function switches to a new mapset and changes the GISRC file for
     parallel processing.
@@ -374,65 +355,108 @@ def switch_to_new_mapset(new_mapset):
     return gisrc, newgisrc, old_mapset
 
 
-def main():
-    global orig_region
+def wait_for_process(proc):
+    """Wait for a started r.in.pdal process and check its return code
+    Args:
+        proc (Popen): the process started with grass.start_command
+    """
+    proc.wait()
+    if proc.returncode != 0:
+        grass.fatal(_(f"Module <r.in.pdal> failed: {proc.args}"))
 
-    res = options["res"]
 
-    orig_region = grass.tempname(12)
-    grass.run_command("g.region", save=orig_region, quiet=True)
+def main():
+    res = options["res"]
 
     # switch to another mapset for parallel processing
     new_mapset = options["new_mapset"]
     if new_mapset:
         gisrc, newgisrc, old_mapset = switch_to_new_mapset(new_mapset)
 
-    r_in_pdal_kwargs = dict()
-    for key, val in options.items():
-        if key not in ["new_mapset", "res"]:
-            if val:
-                r_in_pdal_kwargs[key] = val
-
-    reg_extent_laz = grass.parse_command(
-        "r.in.pdal",
-        flags="g",
-        **r_in_pdal_kwargs,
-    )
-    reg_laz_split = reg_extent_laz["n"].split(" ")
-    grass.run_command(
-        "g.region",
-        n=float(reg_laz_split[0]),
-        s=float(reg_laz_split[1].replace("s=", "")),
-        e=float(reg_laz_split[2].replace("e=", "")),
-        w=float(reg_laz_split[3].replace("w=", "")),
-        res=1,
-        flags="a",
-    )
-    grass.run_command(
-        "g.region",
-        res=res,
-    )
-    # for no missing values at the border of the whole area we grow it
-    grass.run_command("g.region", grow=5)
-    r_in_pdal_kwargs["flags"] = ""
-    for key, val in flags.items():
-        if val:
-            r_in_pdal_kwargs["flags"] += key
-    grass.run_command("r.in.pdal", **r_in_pdal_kwargs)
+    r_in_pdal_kwargs = {
+        key: val
+        for key, val in options.items()
+        if val
+        and key not in ("new_mapset", "res", "nprocs", "input", "output")
+    }
+    r_in_pdal_flags = "".join(key for key, val in flags.items() if val)
+
+    # several LAS files can be imported by one worker, so that the mapset is
+    # only created once for all of them
+    outputs = options["output"].split(",")
+    if options["input"]:
+        inputs = options["input"].split(",")
+        if len(inputs) != len(outputs):
+            grass.fatal(
+                _("The number of input files and output maps must be equal")
+            )
+    else:
+        # the input files are given by the file option
+        inputs = [None]
+
+    nprocs = int(options["nprocs"])
+    if nprocs < 1:
+        nprocs = 1
+    procs = []
+    for inp, output in zip(inputs, outputs):
+        input_kwargs = dict()
+        if output:
+            input_kwargs["output"] = output
+        if inp:
+            input_kwargs["input"] = inp
+        # r.in.pdal -g prints the extent in one line as "n=... s=... e=...
+        # w=...", so every key=value pair is put on its own line for parsing
+        reg_extent_laz = grass.parse_key_val(
+            grass.read_command(
+                "r.in.pdal",
+                flags="g",
+                **r_in_pdal_kwargs,
+                **input_kwargs,
+            ).replace(" ", "\n")
+        )
+        n, s, e, w = (float(reg_extent_laz[key]) for key in "nsew")
+        # set the region to the LAS extent rounded to full meters and grown
+        # by 5 cells (for no missing values at the border of the whole area);
+        # the region is passed to r.in.pdal with GRASS_REGION, so that
+        # several files can be imported in parallel in the same mapset
+        grow = 5 * float(res)
+        env = os.environ.copy()
+        env["GRASS_REGION"] = grass.region_env(
+            n=math.ceil(n) + grow,
+            s=math.floor(s) - grow,
+            e=math.ceil(e) + grow,
+            w=math.floor(w) - grow,
+            res=res,
+            flags="a",
+        )
+        if len(procs) >= nprocs:
+            wait_for_process(procs.pop(0))
+        procs.append(
+            grass.start_command(
+                "r.in.pdal",
+                flags=r_in_pdal_flags,
+                **r_in_pdal_kwargs,
+                **input_kwargs,
+                env=env,
+            )
+        )
+    for proc in procs:
+        wait_for_process(proc)
 
     # set GISRC to original gisrc and delete newgisrc
     if new_mapset:
         os.environ["GISRC"] = gisrc
         grass.utils.try_remove(newgisrc)
-        msg = f"Output raster created <{options['output']}@{new_mapset}>."
-    else:
-        msg = f"Output raster created <{options['output']}>."
 
-    grass.message(_(msg))
+    for output in outputs:
+        if new_mapset:
+            msg = f"Output raster created <{output}@{new_mapset}>."
+        else:
+            msg = f"Output raster created <{output}>."
+        grass.message(_(msg))
     return 0
 
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-    atexit.register(cleanup)
     main()